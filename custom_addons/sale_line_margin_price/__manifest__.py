@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 {
     'name': 'Sale Line Margin Pricing',
-    'version': '19.0.1.0.0',
+    'version': '19.0.1.2.0',
     'category': 'Sales/Sales',
     'summary': 'Calculate sale prices automatically from product cost plus configurable margin percentage',
     'description': """
@@ -30,8 +30,19 @@ Perfect for businesses that need dynamic cost-plus pricing!
         'product',
     ],
     'data': [
+        'security/ir.model.access.csv',
+        'security/sale_line_margin_price_security.xml',
+        'data/sale_line_margin_price_data.xml',
+        'wizard/sale_margin_line_import_views.xml',
+        'wizard/sale_order_target_margin_views.xml',
         'views/sale_order_line_view.xml',
+        'views/sale_order_template_views.xml',
+        'views/sale_margin_rule_views.xml',
+        'views/sale_margin_analysis_views.xml',
+        'views/res_config_settings_views.xml',
     ],
+    'pre_init_hook': 'pre_init_hook',
+    'post_init_hook': 'post_init_hook',
     'images': [
         'static/description/icon.png',
         'static/description/banner.png',
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import datetime
+import hmac
+import io
+import tempfile
+
+from werkzeug.exceptions import BadRequest, NotFound
+
+from odoo import api, fields, http, _
+from odoo.exceptions import UserError
+from odoo.http import content_disposition, request
+
+from ..models.sale_order_line import MARGIN_EXPORT_COLUMNS
+from ..tools import METRICS_TOKEN_PARAM, margin_metrics
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+# Bytes per chunk when streaming the XLSX export file
+EXPORT_STREAM_CHUNK_SIZE = 65536
+
+EXPORT_CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+class SaleLineMarginPriceController(http.Controller):
+
+    @http.route('/sale_line_margin_price/metrics', type='http', auth='public', methods=['GET'], save_session=False)
+    def metrics(self):
+        """
+        Margin pricing metrics of this server process in the Prometheus text
+        format. Only served to scrapers sending the token of the
+        METRICS_TOKEN_PARAM system parameter ("Authorization: Bearer <token>"),
+        not at all while no token is configured.
+        """
+        token = request.env['ir.config_parameter'].sudo().get_param(METRICS_TOKEN_PARAM)
+        authorization = request.httprequest.headers.get('Authorization', '')
+        if not token or not hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode()):
+            raise NotFound()
+        return request.make_response(
+            margin_metrics.render_prometheus(),
+            headers=[('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')],
+        )
+
+    @http.route('/sale_line_margin_price/simulate', type='jsonrpc', auth='user', methods=['POST'], readonly=True)
+    def simulate(self, items, company_id=None):
+        """
+        Price a batch of products at given margins without creating order
+        lines, see sale.line.margin.pricing.simulate_margin_prices for the
+        format of items and of the result.
+        """
+        return request.env['sale.line.margin.pricing'].simulate_margin_prices(items, company_id=company_id)
+
+    @http.route('/sale_line_margin_price/export', type='http', auth='user', methods=['GET'], readonly=True)
+    def export_margins(self, file_format='csv', state=None, date_from=None, date_to=None, user_id=None):
+        """
+        Stream the margin data of the order lines the user can read as a CSV
+        or XLSX file, whatever their number.
+
+        :param file_format: 'csv' or 'xlsx'
+        :param state: comma-separated order states, e.g. "draft,sent"
+        :param date_from: first order date (YYYY-MM-DD), inclusive
+        :param date_to: last order date (YYYY-MM-DD), inclusive
+        :param user_id: id of the salesperson of the orders
+        """
+        if file_format not in EXPORT_CONTENT_TYPES:
+            raise BadRequest(f"Unsupported export format {file_format!r}")
+        if file_format == 'xlsx' and xlsxwriter is None:
+            raise UserError(_("The xlsxwriter library is required to export XLSX files."))
+        try:
+            domain = self._get_margin_export_domain(state, date_from, date_to, user_id)
+        except ValueError as e:
+            raise BadRequest(str(e))
+        request.env['sale.order.line'].check_access('read')
+
+        # The request cursor is closed once the response is returned, rows
+        # are read while the body is sent, from a cursor of their own
+        registry, uid, context = request.env.registry, request.env.uid, dict(request.env.context)
+
+        def iter_batches():
+            with registry.cursor(readonly=True) as cr:
+                env = api.Environment(cr, uid, context)
+                yield from env['sale.order.line']._iter_margin_export_rows(domain)
+
+        body = self._stream_csv(iter_batches()) if file_format == 'csv' else self._stream_xlsx(iter_batches())
+        filename = f"margins_{fields.Date.context_today(request.env.user)}.{file_format}"
+        return request.make_response(body, headers=[
+            ('Content-Type', EXPORT_CONTENT_TYPES[file_format]),
+            ('Content-Disposition', content_disposition(filename)),
+        ])
+
+    def _get_margin_export_domain(self, state, date_from, date_to, user_id):
+        domain = [('display_type', '=', False)]
+        if state:
+            domain.append(('order_id.state', 'in', state.split(',')))
+        if date_from:
+            domain.append(('order_id.date_order', '>=', fields.Date.to_date(date_from)))
+        if date_to:
+            domain.append(('order_id.date_order', '<', fields.Date.to_date(date_to) + datetime.timedelta(days=1)))
+        if user_id:
+            domain.append(('order_id.user_id', '=', int(user_id)))
+        return domain
+
+    def _stream_csv(self, batches):
+        """Yield the CSV file one encoded batch of rows at a time"""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(MARGIN_EXPORT_COLUMNS)
+        for rows in batches:
+            writer.writerows(rows)
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue().encode()
+
+    def _stream_xlsx(self, batches):
+        """
+        Yield the XLSX file in chunks. An XLSX file is a zip archive, only
+        complete once written: the workbook is built in a temporary file in
+        constant memory mode (each row is flushed to disk once written),
+        then streamed.
+        """
+        with tempfile.TemporaryFile() as xlsx_file:
+            workbook = xlsxwriter.Workbook(xlsx_file, {'constant_memory': True, 'remove_timezone': True})
+            sheet = workbook.add_worksheet('Margins')
+            date_format = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+            sheet.write_row(0, 0, MARGIN_EXPORT_COLUMNS)
+            row_index = 1
+            for rows in batches:
+                for row in rows:
+                    sheet.write_row(row_index, 0, row)
+                    sheet.write_datetime(row_index, 1, row[1], date_format)
+                    row_index += 1
+            workbook.close()
+
+            xlsx_file.seek(0)
+            while chunk := xlsx_file.read(EXPORT_STREAM_CHUNK_SIZE):
+                yield chunk
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import time
+
+from odoo.tools import SQL
+from odoo.tools.sql import column_exists, create_column
+
+from .models.sale_margin_rule import DEFAULT_MARGIN_PERCENT
+
+_logger = logging.getLogger(__name__)
+
+# Number of order line ids covered by each UPDATE when filling the columns
+FILL_CHUNK_SIZE = 200000
+# Number of lines recomputed at once by the ORM when SQL cannot fill them
+RECOMPUTE_CHUNK_SIZE = 1000
+
+
+def pre_init_hook(env):
+    """
+    Create the stored columns of sale.order.line before the ORM does: the
+    ORM would compute cost_price and margin_amount in Python for every
+    existing line, post_init_hook fills them with set-based SQL instead.
+    """
+    _create_margin_columns(env.cr)
+
+
+def post_init_hook(env):
+    _fill_cost_price(env)
+    _fill_confirmed_cost_price(env)
+    _fill_margin_amount(env)
+
+
+def _create_margin_columns(cr):
+    """Add the margin columns of sale_order_line that do not exist yet"""
+    if not column_exists(cr, 'sale_order_line', 'margin_percent'):
+        # A constant default is only stored in the catalog, existing rows are not rewritten
+        cr.execute(SQL(
+            "ALTER TABLE sale_order_line ADD COLUMN margin_percent float8 DEFAULT %s",
+            DEFAULT_MARGIN_PERCENT,
+        ))
+        cr.execute(SQL("ALTER TABLE sale_order_line ALTER COLUMN margin_percent DROP DEFAULT"))
+    for column, column_type in (
+        ('cost_price', 'float8'),
+        ('confirmed_cost_price', 'float8'),
+        ('cost_confirmed', 'boolean'),
+        ('margin_amount', 'numeric'),
+        ('margin_price_manual', 'boolean'),
+    ):
+        if not column_exists(cr, 'sale_order_line', column):
+            create_column(cr, 'sale_order_line', column, column_type)
+
+
+def _iter_line_id_ranges(cr, chunk_size):
+    """Yield (start, stop) ranges of sale_order_line ids covering the table"""
+    cr.execute(SQL("SELECT MIN(id), MAX(id) FROM sale_order_line"))
+    min_id, max_id = cr.fetchone()
+    if min_id is None:
+        return
+    for start in range(min_id, max_id + 1, chunk_size):
+        yield start, min(start + chunk_size, max_id + 1)
+
+
+def _fill_by_chunks(cr, description, query, chunk_size):
+    """
+    Run query on consecutive id ranges of sale_order_line and log the
+    progress after each range.
+
+    :param query: callable (start, stop) returning the SQL of one range
+    :return: number of updated lines
+    """
+    ranges = list(_iter_line_id_ranges(cr, chunk_size))
+    start_time = time.perf_counter()
+    updated = 0
+    for index, (start, stop) in enumerate(ranges, 1):
+        cr.execute(query(start, stop))
+        updated += cr.rowcount
+        elapsed = time.perf_counter() - start_time
+        _logger.info(
+            "%s: %s/%s chunks, %s lines in %.0fs (%.0f lines/s)",
+            description, index, len(ranges), updated, elapsed, updated / elapsed if elapsed else 0.0,
+        )
+    return updated
+
+
+def _fill_cost_price(env, chunk_size=FILL_CHUNK_SIZE):
+    """
+    Set cost_price of all order lines from the company dependent
+    standard_price of their product, in the company of the line. Companies
+    without a cost for a product get the default cost, as the ORM would.
+    """
+    cr = env.cr
+    env.flush_all()
+    defaults = {
+        str(company.id): env['ir.default']._get('product.product', 'standard_price', company_id=company.id) or 0.0
+        for company in env['res.company'].with_context(active_test=False).search([])
+    }
+
+    def query(start, stop):
+        return SQL(
+            """
+            UPDATE sale_order_line line
+               SET cost_price = COALESCE(
+                       (product.standard_price->>line.company_id::text)::float8,
+                       (%s::jsonb->>line.company_id::text)::float8,
+                       0.0
+                   )
+              FROM product_product product
+             WHERE product.id = line.product_id
+               AND line.id >= %s AND line.id < %s
+            """,
+            json.dumps(defaults), start, stop,
+        )
+
+    updated = _fill_by_chunks(cr, "Initializing sale order line cost prices", query, chunk_size)
+    # Lines without product have no cost
+    cr.execute(SQL("UPDATE sale_order_line SET cost_price = 0.0 WHERE product_id IS NULL"))
+    env['sale.order.line'].invalidate_model(['cost_price'])
+    return updated
+
+
+def _fill_confirmed_cost_price(env, chunk_size=FILL_CHUNK_SIZE):
+    """
+    Freeze the cost of the lines of confirmed orders that have none yet, as
+    action_confirm does: their current cost_price is the best known cost.
+    """
+    cr = env.cr
+    env.flush_all()
+
+    def query(start, stop):
+        return SQL(
+            """
+            UPDATE sale_order_line line
+               SET confirmed_cost_price = line.cost_price,
+                   cost_confirmed = TRUE
+              FROM sale_order so
+             WHERE so.id = line.order_id
+               AND so.state = 'sale'
+               AND line.cost_confirmed IS NOT TRUE
+               AND line.id >= %s AND line.id < %s
+            """,
+            start, stop,
+        )
+
+    updated = _fill_by_chunks(cr, "Freezing the cost of confirmed sale order lines", query, chunk_size)
+    env['sale.order.line'].invalidate_model(['confirmed_cost_price', 'cost_confirmed'])
+    return updated
+
+
+def _fill_margin_amount(env, chunk_size=FILL_CHUNK_SIZE):
+    """
+    Set margin_amount of all order lines: subtotal minus cost (frozen at
+    confirmation for confirmed orders) times quantity, the cost converted
+    with the currency rate of the order.
+    Lines sold in another UoM than their product's are left to the ORM,
+    which converts the cost to the line UoM.
+    """
+    cr = env.cr
+    env.flush_all()
+
+    def query(start, stop):
+        return SQL(
+            """
+            UPDATE sale_order_line line
+               SET margin_amount = COALESCE(line.price_subtotal, 0.0)
+                   - COALESCE(CASE WHEN line.cost_confirmed THEN line.confirmed_cost_price ELSE line.cost_price END, 0.0)
+                     * COALESCE(line.product_uom_qty, 0.0)
+                     * COALESCE(NULLIF(so.currency_rate, 0.0), 1.0)
+              FROM sale_order so, product_product product, product_template template
+             WHERE so.id = line.order_id
+               AND product.id = line.product_id
+               AND template.id = product.product_tmpl_id
+               AND line.product_uom_id IS NOT DISTINCT FROM template.uom_id
+               AND line.id >= %s AND line.id < %s
+            """,
+            start, stop,
+        )
+
+    updated = _fill_by_chunks(cr, "Initializing sale order line margin amounts", query, chunk_size)
+    # Lines without product have no cost
+    cr.execute(SQL(
+        """
+        UPDATE sale_order_line
+           SET margin_amount = COALESCE(price_subtotal, 0.0)
+         WHERE product_id IS NULL
+        """
+    ))
+    Line = env['sale.order.line']
+    Line.invalidate_model(['margin_amount'])
+
+    cr.execute(SQL("SELECT id FROM sale_order_line WHERE margin_amount IS NULL ORDER BY id"))
+    remaining_ids = [row[0] for row in cr.fetchall()]
+    if remaining_ids:
+        _logger.info("Computing the margin amount of %s lines sold in another UoM", len(remaining_ids))
+        for index in range(0, len(remaining_ids), RECOMPUTE_CHUNK_SIZE):
+            lines = Line.browse(remaining_ids[index:index + RECOMPUTE_CHUNK_SIZE])
+            env.add_to_compute(Line._fields['margin_amount'], lines)
+            lines.flush_recordset(['margin_amount'])
+            env.invalidate_all()
+    return updated
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+from odoo import api, SUPERUSER_ID
+from odoo.addons.sale_line_margin_price.hooks import _fill_margin_amount
+
+
+def migrate(cr, version):
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    _fill_margin_amount(env)
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+
+from odoo.addons.sale_line_margin_price.hooks import _create_margin_columns
+
+
+def migrate(cr, version):
+    # margin_amount is new: create it before the ORM computes it line by line
+    _create_margin_columns(cr)
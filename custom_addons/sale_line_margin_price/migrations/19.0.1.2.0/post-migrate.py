@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+from odoo import api, SUPERUSER_ID
+from odoo.addons.sale_line_margin_price.hooks import _fill_confirmed_cost_price
+
+
+def migrate(cr, version):
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    _fill_confirmed_cost_price(env)
@@ -1,3 +1,12 @@
 # -*- coding: utf-8 -*-
 
+from . import product_product
+from . import res_company
+from . import res_config_settings
+from . import sale_line_margin_pricing
+from . import sale_line_margin_repricing
+from . import sale_margin_analysis
+from . import sale_margin_rule
+from . import sale_order
 from . import sale_order_line
+from . import sale_order_template_line
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models
+
+
+class ProductProduct(models.Model):
+    _inherit = 'product.product'
+
+    def write(self, vals):
+        """
+        Override write to push a standard_price change to the open quotation
+        lines of these products (cost_price and margin price).
+        """
+        res = super(ProductProduct, self).write(vals)
+        if 'standard_price' in vals:
+            self.env['sale.order.line']._propagate_cost_price(self)
+        return res
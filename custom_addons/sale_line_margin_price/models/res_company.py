@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields
+
+
+class ResCompany(models.Model):
+    _inherit = 'res.company'
+
+    margin_rule_version = fields.Integer(
+        string='Margin Rule Version',
+        default=0,
+        copy=False,
+        help='Bumped on every change of the margin rules of the company, keys the cached rule index'
+    )
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields
+
+
+class ResConfigSettings(models.TransientModel):
+    _inherit = 'res.config.settings'
+
+    sale_margin_price_mode = fields.Selection(
+        selection=[
+            ('onchange', 'On change and save'),
+            ('compute', 'Computed'),
+        ],
+        string='Margin Price Mode',
+        default='onchange',
+        config_parameter='sale_line_margin_price.price_mode',
+        help='On change and save: the margin price is set by onchanges and again when lines are saved.\n'
+             'Computed: the unit price is computed once, in batch, from the margin; prices entered '
+             'by hand are kept until the margin or product changes.'
+    )
+
+    sale_margin_pricelist_mode = fields.Selection(
+        selection=[
+            ('margin', 'Margin price'),
+            ('floor', 'Pricelist price, margin price as floor'),
+            ('adjust', 'Margin on top of the pricelist price'),
+        ],
+        string='Margin and Pricelist',
+        default='margin',
+        config_parameter='sale_line_margin_price.pricelist_mode',
+        help='Margin price: the margin price replaces the pricelist price.\n'
+             'Floor: the pricelist price applies, raised to the margin price when lower.\n'
+             'On top: the margin is applied to the pricelist price instead of the cost.'
+    )
+
+    sale_margin_concurrent_updates = fields.Boolean(
+        string='Concurrent Margin Updates',
+        config_parameter='sale_line_margin_price.concurrent_updates',
+        help='Lock the lines and their order in a fixed order when only the margin changes, '
+             'for large quotations edited by several users at once.'
+    )
@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+from collections import defaultdict
+
+from odoo import models, fields, api, tools, _
+from odoo.exceptions import AccessError, UserError
+from odoo.tools import float_round, str2bool
+
+from ..tools import METRICS_ENABLED_PARAM, instrumented
+from .sale_margin_rule import DEFAULT_MARGIN_PERCENT
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# System parameter selecting how the margin price and the pricelist price combine:
+# 'margin' (default): the margin price replaces the pricelist price
+# 'floor': the pricelist price, raised to the margin price when lower
+# 'adjust': the margin is applied on top of the pricelist price
+PRICELIST_MODE_PARAM = 'sale_line_margin_price.pricelist_mode'
+
+
+class SaleLineMarginPricing(models.AbstractModel):
+    """
+    Shared margin pricing service used by every sale.order.line entry point
+    (onchanges, create, write).
+
+    Product costs are read through the ORM record cache, in one query for
+    all the products of a batch. Unlike a table kept in the cursor's
+    precommit data, that cache is invalidated by writes and by savepoint
+    rollbacks, so a rolled back standard_price is never served afterwards.
+
+    Costs are in the company currency and the product UoM; the currency
+    rates and UoM factors that convert them to the currency and UoM of a
+    line are memoized for the duration of a call, so a quotation costs one
+    rate lookup per distinct (currency, company, date) whatever its number
+    of lines.
+    """
+    _name = 'sale.line.margin.pricing'
+    _description = 'Sale Line Margin Pricing'
+
+    @api.model
+    def _get_costs(self, products, company=None):
+        """
+        Return {product_id: standard_price} for products in company.
+        Products missing from the record cache are read together in one query.
+
+        :param products: product.product recordset
+        :param company: res.company record, defaults to the current company
+        """
+        company = company or self.env.company
+        # Iterating a browsed recordset prefetches the field for all its records
+        return {
+            product.id: product.standard_price or 0.0
+            for product in self.env['product.product'].with_company(company).browse(products.ids)
+        }
+
+    @api.model
+    def _get_conversion_rates(self, keys):
+        """
+        Return {(from_currency_id, to_currency_id, company_id, date): rate}
+        for keys, computing each distinct rate once.
+        """
+        cache = {}
+        Currency = self.env['res.currency']
+        for key in set(keys) - cache.keys():
+            from_currency_id, to_currency_id, company_id, date = key
+            if from_currency_id == to_currency_id:
+                cache[key] = 1.0
+                continue
+            cache[key] = Currency._get_conversion_rate(
+                Currency.browse(from_currency_id),
+                Currency.browse(to_currency_id),
+                self.env['res.company'].browse(company_id),
+                date,
+            )
+        return {key: cache[key] for key in keys}
+
+    @api.model
+    def _get_uom_factors(self, keys):
+        """
+        Return {(from_uom_id, to_uom_id): factor} for keys, where factor
+        converts a price per from_uom into a price per to_uom.
+        """
+        cache = {}
+        Uom = self.env['uom.uom']
+        for key in set(keys) - cache.keys():
+            from_uom_id, to_uom_id = key
+            if not from_uom_id or not to_uom_id or from_uom_id == to_uom_id:
+                cache[key] = 1.0
+                continue
+            # Prices are linear in the UoM: convert a unit price once per pair
+            cache[key] = Uom.browse(from_uom_id)._compute_price(1.0, Uom.browse(to_uom_id))
+        return {key: cache[key] for key in keys}
+
+    @api.model
+    def _get_cost_conversion_factors(self, items):
+        """
+        Factors converting product costs (company currency, product UoM)
+        into the currency and UoM of the lines described by items.
+
+        :param items: list of (product, company, currency, uom, date) tuples,
+            where currency, uom and date may be empty (no conversion, today)
+        :return: list of factors, in the order of items
+        """
+        today = fields.Date.context_today(self)
+        rate_keys = []
+        uom_keys = []
+        for product, company, currency, uom, date in items:
+            rate_keys.append((
+                company.currency_id.id,
+                (currency or company.currency_id).id,
+                company.id,
+                fields.Date.to_date(date) or today,
+            ))
+            uom_keys.append((product.uom_id.id, (uom or product.uom_id).id))
+        rates = self._get_conversion_rates(rate_keys)
+        uom_factors = self._get_uom_factors(uom_keys)
+        return [rates[rate_key] * uom_factors[uom_key] for rate_key, uom_key in zip(rate_keys, uom_keys)]
+
+    @api.model
+    @tools.ormcache()
+    def _is_metrics_enabled(self):
+        """
+        Whether METRICS_ENABLED_PARAM is set, read once and kept in the
+        registry cache, which system parameter changes clear
+        """
+        return str2bool(self.env['ir.config_parameter'].sudo().get_param(METRICS_ENABLED_PARAM) or False)
+
+    @api.model
+    def _get_pricelist_mode(self):
+        """How margin and pricelist prices combine, see PRICELIST_MODE_PARAM"""
+        return self.env['ir.config_parameter'].sudo().get_param(PRICELIST_MODE_PARAM) or 'margin'
+
+    @api.model
+    def _get_pricelist_brackets(self, pricelist):
+        """
+        Sorted minimum quantities of the rules of pricelist and of the
+        pricelists its rules are based on: between two brackets, the same
+        rules apply whatever the quantity.
+        """
+        brackets = {0.0}
+        seen = self.env['product.pricelist']
+        todo = pricelist
+        while todo:
+            seen |= todo
+            items = todo.item_ids
+            brackets.update(items.mapped('min_quantity'))
+            todo = items.filtered(lambda item: item.base == 'pricelist').base_pricelist_id - seen
+        return sorted(brackets)
+
+    @api.model
+    def _get_pricelist_prices(self, items):
+        """
+        Pricelist prices of order lines, computed in batch: the rules of a
+        pricelist are evaluated once per (company, currency, date, quantity
+        bracket) for all the products priced with it.
+
+        :param items: list of (pricelist, product, company, currency, uom,
+            quantity, date) tuples, the quantity in the given uom
+        :return: list of prices in the currency and uom of each item
+        """
+        cache = {}
+        brackets_by_pricelist = {}
+        today = fields.Date.context_today(self)
+        uom_factors = self._get_uom_factors([
+            (product.uom_id.id, (uom or product.uom_id).id)
+            for _pricelist, product, _company, _currency, uom, _quantity, _date in items
+        ])
+
+        keys = []
+        missing = defaultdict(set)
+        for pricelist, product, company, currency, uom, quantity, date in items:
+            factor = uom_factors[(product.uom_id.id, (uom or product.uom_id).id)]
+            # Rules compare their minimum quantity to the quantity in the product UoM
+            product_quantity = (quantity or 0.0) * factor
+            if pricelist.id not in brackets_by_pricelist:
+                brackets_by_pricelist[pricelist.id] = self._get_pricelist_brackets(pricelist)
+            brackets = brackets_by_pricelist[pricelist.id]
+            bracket = brackets[max(bisect.bisect_right(brackets, product_quantity) - 1, 0)]
+            group = (pricelist.id, company.id, (currency or company.currency_id).id, fields.Date.to_date(date) or today, bracket)
+            key = group[:1] + (product.id,) + group[1:]
+            keys.append((key, factor))
+            if key not in cache:
+                missing[group].add(product.id)
+
+        for (pricelist_id, company_id, currency_id, date, bracket), product_ids in missing.items():
+            pricelist = self.env['product.pricelist'].browse(pricelist_id).with_company(company_id)
+            results = pricelist._compute_price_rule(
+                self.env['product.product'].with_company(company_id).browse(list(product_ids)),
+                bracket,
+                currency=self.env['res.currency'].browse(currency_id),
+                date=date,
+            )
+            for product_id, (price, _rule_id) in results.items():
+                cache[(pricelist_id, product_id, company_id, currency_id, date, bracket)] = price
+
+        return [cache[key] * factor for key, factor in keys]
+
+    @api.model
+    def _compute_line_prices(self, costs, margins, roundings, pricelist_items=None):
+        """
+        Final prices of order lines: the margin prices of costs, combined
+        with the pricelist prices of pricelist_items according to the
+        pricelist mode (see PRICELIST_MODE_PARAM).
+
+        :param pricelist_items: items of _get_pricelist_prices, aligned with
+            costs, or None to ignore pricelists
+        :return: list of prices, in the order of costs
+        """
+        mode = self._get_pricelist_mode()
+        if mode == 'margin' or pricelist_items is None:
+            return self._compute_margin_prices(costs, margins, roundings)
+
+        pricelist_prices = self._get_pricelist_prices(pricelist_items)
+        if mode == 'adjust':
+            return self._compute_margin_prices(pricelist_prices, margins, roundings)
+
+        margin_prices = self._compute_margin_prices(costs, margins, roundings)
+        # Round the pricelist prices like the margin prices before comparing them
+        pricelist_prices = self._compute_margin_prices(pricelist_prices, [0.0] * len(pricelist_prices), roundings)
+        if numpy is None:
+            return [max(margin_price, pricelist_price) for margin_price, pricelist_price in zip(margin_prices, pricelist_prices)]
+        return numpy.maximum(margin_prices, pricelist_prices).tolist()
+
+    @api.model
+    @instrumented('simulate', count_records=lambda self, items, company_id=None: len(items))
+    def simulate_margin_prices(self, items, company_id=None):
+        """
+        Price products at given margins as order lines would be priced, but
+        without creating or locking any record (CPQ, portal price checks).
+
+        Products, costs, margin rules, currency rates, UoM factors and
+        pricelist rules are read in bulk for the whole batch.
+
+        :param items: list of dicts with the key product_id and optionally:
+            quantity (default 1.0), margin_percent (default: margin rules),
+            uom_id, pricelist_id, currency_id (default: the pricelist or
+            company currency), partner_id (for margin rules) and date
+        :param company_id: company to price in, defaults to the current one
+        :return: list of dicts, in the order of items, with the keys
+            product_id, quantity, margin_percent, currency_id, cost (unit
+            cost in the currency and UoM), price (unit price) and
+            margin_amount (for the quantity)
+        """
+        company = self.env['res.company'].browse(company_id) if company_id else self.env.company
+        if company not in self.env.user.company_ids:
+            raise AccessError(_("You cannot price products in company %s.", company.display_name))
+        today = fields.Date.context_today(self)
+
+        def records(model, key):
+            browsed = self.env[model].browse(list({item[key] for item in items if item.get(key)}))
+            return {record.id: record for record in browsed.exists()}
+
+        products = records('product.product', 'product_id')
+        missing_ids = {item['product_id'] for item in items} - products.keys()
+        if missing_ids:
+            raise UserError(_("Unknown products: %s", ", ".join(map(str, sorted(missing_ids)))))
+        pricelists = records('product.pricelist', 'pricelist_id')
+        currencies = records('res.currency', 'currency_id')
+        uoms = records('uom.uom', 'uom_id')
+        Pricelist = self.env['product.pricelist']
+        Currency = self.env['res.currency']
+        Uom = self.env['uom.uom']
+
+        lines = []
+        for item in items:
+            pricelist = pricelists.get(item.get('pricelist_id'), Pricelist)
+            lines.append({
+                'product': products[item['product_id']],
+                'quantity': item.get('quantity', 1.0),
+                'pricelist': pricelist,
+                'currency': currencies.get(item.get('currency_id'), Currency) or pricelist.currency_id or company.currency_id,
+                'uom': uoms.get(item.get('uom_id'), Uom),
+                'date': fields.Date.to_date(item.get('date')) or today,
+            })
+
+        # Margins not given come from the margin rules, resolved all at once
+        to_resolve = [index for index, item in enumerate(items) if item.get('margin_percent') is None]
+        margins = [item.get('margin_percent') for item in items]
+        resolved = self.env['sale.margin.rule']._resolve_margin_percents([
+            (items[index]['product_id'], items[index].get('partner_id'), items[index].get('pricelist_id'), lines[index]['date'])
+            for index in to_resolve
+        ], company)
+        for index, margin_percent in zip(to_resolve, resolved):
+            margins[index] = DEFAULT_MARGIN_PERCENT if margin_percent is None else margin_percent
+
+        product_costs = self._get_costs(self.env['product.product'].browse(list(products)), company)
+        factors = self._get_cost_conversion_factors([
+            (line['product'], company, line['currency'], line['uom'], line['date']) for line in lines
+        ])
+        costs = [product_costs[line['product'].id] * factor for line, factor in zip(lines, factors)]
+        pricelist_items = [
+            (line['pricelist'], line['product'], company, line['currency'], line['uom'], line['quantity'], line['date'])
+            for line in lines
+        ]
+        rounding = 10 ** -self.env['decimal.precision'].precision_get('Product Price')
+        prices = self._compute_line_prices(costs, margins, rounding, pricelist_items)
+
+        # Like order lines, products without cost keep their pricelist price
+        zero_cost = [index for index, cost in enumerate(costs) if not cost]
+        if zero_cost:
+            pricelist_prices = self._get_pricelist_prices([pricelist_items[index] for index in zero_cost])
+            for index, price in zip(zero_cost, pricelist_prices):
+                prices[index] = float_round(price, precision_rounding=rounding)
+
+        return [{
+            'product_id': line['product'].id,
+            'quantity': line['quantity'],
+            'margin_percent': margin_percent,
+            'currency_id': line['currency'].id,
+            'cost': cost,
+            'price': price,
+            'margin_amount': (price - cost) * line['quantity'],
+        } for line, margin_percent, cost, price in zip(lines, margins, costs, prices)]
+
+    @api.model
+    def _compute_margin_price(self, cost, margin_percent):
+        """
+        Selling price for a cost and a margin.
+        Formula: price_unit = cost * (1 + margin_percent/100)
+
+        Note: margin_percent is stored as a number (100 for 100%, 20 for 20%)
+        """
+        return (cost or 0.0) * (1.0 + ((margin_percent or 0.0) / 100.0))
+
+    @api.model
+    def _get_margin_price(self, product, margin_percent, company=None):
+        """Margin-based selling price of a single product"""
+        if not product:
+            return 0.0
+        cost = self._get_costs(product, company)[product.id]
+        return self._compute_margin_price(cost, margin_percent)
+
+    @api.model
+    def _compute_margin_prices(self, costs, margins, roundings):
+        """
+        Vectorized margin pricing kernel for batch paths (create, mass
+        write, re-pricing, imports, simulations).
+
+        Computes cost * (1 + margin/100) for all items at once and rounds
+        each price HALF-UP to its rounding precision, like float_round does
+        on the scalar path. Falls back to a Python loop when NumPy is not
+        installed.
+
+        :param costs: sequence of costs
+        :param margins: sequence of margin percentages
+        :param roundings: sequence of rounding precisions (e.g. currency
+            rounding, 0.01), or a single precision for all items
+        :return: list of prices, in the order of costs
+        """
+        if numpy is None:
+            if not isinstance(roundings, (list, tuple)):
+                roundings = [roundings] * len(costs)
+            return [
+                float_round(self._compute_margin_price(cost, margin), precision_rounding=rounding)
+                for cost, margin, rounding in zip(costs, margins, roundings)
+            ]
+
+        costs = numpy.asarray(costs, dtype=float)
+        margins = numpy.asarray(margins, dtype=float)
+        roundings = numpy.asarray(roundings, dtype=float)
+        prices = numpy.nan_to_num(costs) * (1.0 + numpy.nan_to_num(margins) / 100.0)
+
+        # Same HALF-UP rounding as float_round: shift the normalized value
+        # by one ulp-sized epsilon away from zero, then round half away from zero
+        normalized = prices / roundings
+        with numpy.errstate(divide='ignore'):
+            epsilon = numpy.exp2(numpy.log2(numpy.abs(normalized)) - 52)
+        normalized += numpy.sign(normalized) * epsilon
+        rounded = numpy.sign(normalized) * numpy.floor(numpy.abs(normalized) + 0.5)
+        return (rounded * roundings).tolist()
+
+    @api.model
+    def _solve_target_margins(self, weights, margins, required_revenue, method='uniform', margin_rounding=0.0):
+        """
+        Solve the margins of order lines so that their revenue adds up to
+        required_revenue, in one vectorized pass.
+
+        The revenue of a line is weight * (1 + margin/100), its weight being
+        unit cost * quantity * (1 - discount/100).
+
+        :param weights: sequence of line weights
+        :param margins: sequence of current line margins
+        :param required_revenue: revenue the lines must add up to
+        :param method: 'uniform' gives all lines the same margin, 'shift'
+            adds the same amount to every current margin (keeps the spread)
+        :param margin_rounding: step margins are rounded to (e.g. 0.5), the
+            rounding error is absorbed by the line with the largest weight
+        :return: list of margins, in the order of weights
+        """
+        if not len(weights):
+            return []
+        if numpy is None:
+            return self._solve_target_margins_loop(weights, margins, required_revenue, method, margin_rounding)
+
+        weights = numpy.asarray(weights, dtype=float)
+        margins = numpy.asarray(margins, dtype=float)
+        total_weight = weights.sum()
+        if not total_weight:
+            return margins.tolist()
+
+        if method == 'uniform':
+            solved = numpy.full_like(weights, (required_revenue / total_weight - 1.0) * 100.0)
+        else:
+            revenue = (weights * (1.0 + margins / 100.0)).sum()
+            solved = margins + (required_revenue - revenue) * 100.0 / total_weight
+
+        if margin_rounding:
+            solved = numpy.round(solved / margin_rounding) * margin_rounding
+            residual = required_revenue - (weights * (1.0 + solved / 100.0)).sum()
+            largest = weights.argmax()
+            solved[largest] = numpy.round(
+                (solved[largest] + residual * 100.0 / weights[largest]) / margin_rounding
+            ) * margin_rounding
+        return solved.tolist()
+
+    @api.model
+    def _solve_target_margins_loop(self, weights, margins, required_revenue, method, margin_rounding):
+        """Pure Python version of _solve_target_margins, used without NumPy"""
+        total_weight = sum(weights)
+        if not total_weight:
+            return list(margins)
+
+        if method == 'uniform':
+            solved = [(required_revenue / total_weight - 1.0) * 100.0] * len(weights)
+        else:
+            revenue = sum(weight * (1.0 + margin / 100.0) for weight, margin in zip(weights, margins))
+            delta = (required_revenue - revenue) * 100.0 / total_weight
+            solved = [margin + delta for margin in margins]
+
+        if margin_rounding:
+            solved = [round(margin / margin_rounding) * margin_rounding for margin in solved]
+            residual = required_revenue - sum(
+                weight * (1.0 + margin / 100.0) for weight, margin in zip(weights, solved)
+            )
+            largest = max(range(len(weights)), key=lambda index: weights[index])
+            solved[largest] = round(
+                (solved[largest] + residual * 100.0 / weights[largest]) / margin_rounding
+            ) * margin_rounding
+        return solved
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from odoo import models, api
+from odoo.tools import split_every
+
+_logger = logging.getLogger(__name__)
+
+REPRICE_WORKERS_PARAM = 'sale_line_margin_price.reprice_workers'
+REPRICE_CHUNK_SIZE_PARAM = 'sale_line_margin_price.reprice_chunk_size'
+REPRICE_CHECKPOINT_PARAM = 'sale_line_margin_price.reprice_checkpoint'
+
+DEFAULT_REPRICE_WORKERS = 1
+DEFAULT_REPRICE_CHUNK_SIZE = 200  # orders per chunk
+
+
+class SaleLineMarginRepricing(models.AbstractModel):
+    """
+    Mass re-pricing engine: re-applies the margin formula to every line of
+    the open (draft/sent) quotations, except prices entered by hand (see
+    margin_price_manual).
+
+    Quotations are split into disjoint chunks of orders, each processed and
+    committed on its own cursor by a pool of worker threads. After each
+    committed chunk the highest processed order id is saved as a checkpoint,
+    so an interrupted run resumes where it stopped.
+    """
+    _name = 'sale.line.margin.repricing'
+    _description = 'Sale Line Margin Re-pricing'
+
+    @api.model
+    def reprice_open_quotations(self, order_ids=None, workers=None, chunk_size=None):
+        """
+        Re-price the lines of open quotations.
+
+        :param list order_ids: quotations to re-price; all open quotations
+            (resuming from the last checkpoint) when not given
+        :param int workers: degree of parallelism, defaults to the
+            ``sale_line_margin_price.reprice_workers`` system parameter
+        :param int chunk_size: number of orders per chunk, defaults to the
+            ``sale_line_margin_price.reprice_chunk_size`` system parameter
+        :return: report dict with orders, lines, seconds and lines_per_second
+        """
+        ICP = self.env['ir.config_parameter'].sudo()
+        workers = workers or int(ICP.get_param(REPRICE_WORKERS_PARAM, DEFAULT_REPRICE_WORKERS))
+        chunk_size = chunk_size or int(ICP.get_param(REPRICE_CHUNK_SIZE_PARAM, DEFAULT_REPRICE_CHUNK_SIZE))
+
+        full_run = order_ids is None
+        domain = [('state', 'in', ('draft', 'sent'))]
+        if full_run:
+            domain.append(('id', '>', int(ICP.get_param(REPRICE_CHECKPOINT_PARAM, 0))))
+        else:
+            domain.append(('id', 'in', order_ids))
+        orders = self.env['sale.order'].search(domain, order='id')
+        chunks = list(split_every(chunk_size, orders.ids, list))
+
+        start = time.monotonic()
+        lines_count = 0
+        # In test mode, worker cursors share the test transaction: chunks are
+        # still processed and committed on their own cursors (savepoints),
+        # only the checkpoint is not committed
+        testing = self.env.registry.in_test_mode()
+        if workers <= 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                lines_count += self._reprice_orders(chunk)
+                if full_run and not testing:
+                    self._set_reprice_checkpoint(chunk[-1])
+                    self.env.cr.commit()
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(self._reprice_orders_in_new_cursor, chunk) for chunk in chunks]
+                # Results are consumed in submission order, so the checkpoint
+                # only moves past a chunk once all chunks before it committed
+                for chunk, future in zip(chunks, futures):
+                    lines_count += future.result()
+                    if full_run and not testing:
+                        self._set_reprice_checkpoint(chunk[-1])
+                        self.env.cr.commit()
+
+        if full_run and chunks:
+            self._set_reprice_checkpoint(0)
+
+        seconds = time.monotonic() - start
+        report = {
+            'orders': len(orders),
+            'lines': lines_count,
+            'seconds': seconds,
+            'lines_per_second': lines_count / seconds if seconds else 0.0,
+        }
+        _logger.info(
+            "Re-priced %(lines)s lines of %(orders)s quotations in %(seconds).1fs (%(lines_per_second).0f lines/s)",
+            report,
+        )
+        return report
+
+    @api.model
+    def _reprice_orders(self, order_ids):
+        """Re-price the lines of the given orders, return the number of updated lines"""
+        lines = self.env['sale.order.line'].search([
+            ('order_id', 'in', order_ids),
+            ('order_id.state', 'in', ('draft', 'sent')),
+            ('product_id', '!=', False),
+            ('margin_price_manual', '=', False),
+        ])
+        return lines._apply_margin_price()
+
+    def _reprice_orders_in_new_cursor(self, order_ids):
+        """Worker entry point: re-price a chunk on a dedicated cursor, committed on exit"""
+        with self.env.registry.cursor() as cr:
+            env = api.Environment(cr, self.env.uid, self.env.context)
+            return env[self._name]._reprice_orders(order_ids)
+
+    @api.model
+    def _set_reprice_checkpoint(self, order_id):
+        self.env['ir.config_parameter'].sudo().set_param(REPRICE_CHECKPOINT_PARAM, order_id)
+
+    @api.model
+    def _cron_reprice_open_quotations(self):
+        self.reprice_open_quotations()
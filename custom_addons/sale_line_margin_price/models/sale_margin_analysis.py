@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+import logging
+from datetime import timedelta
+
+from odoo import models, fields, api
+from odoo.tools import SQL, create_index, create_unique_index, index_exists, split_every
+
+_logger = logging.getLogger(__name__)
+
+# System parameter holding the write_date up to which lines were reconciled
+ANALYSIS_WATERMARK_PARAM = 'sale_line_margin_price.analysis_watermark'
+# Key of the pending changes in the cursor's precommit data
+ANALYSIS_DIRTY_KEY = 'sale_margin_analysis.dirty'
+# Number of groups refreshed per statement
+ANALYSIS_REFRESH_CHUNK_SIZE = 1000
+# Unique index on the group key, that refreshes upsert their rows on
+ANALYSIS_GROUP_INDEX = 'sale_margin_analysis_group_uniq'
+# The reconciler reads back this far before the watermark: lines written by
+# transactions that started before the last run but committed after it carry
+# a write_date older than the watermark
+ANALYSIS_RECONCILE_OVERLAP = timedelta(hours=1)
+
+
+class SaleMarginAnalysis(models.Model):
+    """
+    Margin by product, salesperson, company and month over all quotations
+    and orders (cancelled orders excluded), in company currency.
+
+    The table is pre-aggregated: when order lines change, only the groups
+    they belong to (before and after the change) are recomputed, at the end
+    of the transaction. Changes made outside the ORM are caught up by a cron
+    reconciling lines and orders written since the last watermark.
+    Dashboards thus read O(groups) rows instead of aggregating all lines.
+    """
+    _name = 'sale.margin.analysis'
+    _description = 'Sales Margin Analysis'
+    _order = 'date desc, product_id'
+    _log_access = False
+
+    date = fields.Date(string='Month', readonly=True, index=True)
+    product_id = fields.Many2one('product.product', string='Product', readonly=True, index=True)
+    categ_id = fields.Many2one('product.category', string='Product Category', readonly=True)
+    user_id = fields.Many2one('res.users', string='Salesperson', readonly=True)
+    company_id = fields.Many2one('res.company', string='Company', readonly=True)
+    line_count = fields.Integer(string='# Lines', readonly=True)
+    product_uom_qty = fields.Float(string='Quantity', readonly=True)
+    cost_total = fields.Float(string='Cost', readonly=True)
+    revenue_total = fields.Float(string='Revenue', readonly=True)
+    margin_total = fields.Float(string='Margin', readonly=True)
+
+    def init(self):
+        # The reconciler looks up lines and orders by write_date
+        create_index(self.env.cr, 'sale_order_line_write_date_index', 'sale_order_line', ['write_date'])
+        create_index(self.env.cr, 'sale_order_write_date_index', 'sale_order', ['write_date'])
+        if not index_exists(self.env.cr, ANALYSIS_GROUP_INDEX):
+            # On upgrade, drop the groups concurrent refreshes may have
+            # duplicated and the costs of lines sold in another UoM
+            self.env.cr.execute(SQL("SELECT 1 FROM sale_margin_analysis LIMIT 1"))
+            if self.env.cr.rowcount:
+                self._rebuild()
+            create_unique_index(
+                self.env.cr, ANALYSIS_GROUP_INDEX, self._table,
+                ['product_id', 'COALESCE(user_id, 0)', 'date', 'company_id'],
+            )
+
+    # ------------------------------------------------------------------
+    # Incremental maintenance
+    # ------------------------------------------------------------------
+
+    @api.model
+    def _mark_lines_dirty(self, line_ids, capture_old_groups=False):
+        """
+        Schedule the refresh of the groups of the given order lines at the
+        end of the transaction.
+
+        :param capture_old_groups: also refresh the groups the lines belong
+            to right now, before they are moved (product/order change) or
+            deleted
+        """
+        if not line_ids:
+            return
+        data = self.env.cr.precommit.data
+        dirty = data.get(ANALYSIS_DIRTY_KEY)
+        if dirty is None:
+            dirty = data[ANALYSIS_DIRTY_KEY] = {'line_ids': set(), 'groups': set()}
+            self.env.cr.precommit.add(self._refresh_dirty_groups)
+        if capture_old_groups:
+            dirty['groups'].update(self._get_line_groups(line_ids))
+        dirty['line_ids'].update(line_ids)
+
+    @api.model
+    def _refresh_dirty_groups(self):
+        """Precommit hook: recompute the groups touched during the transaction"""
+        dirty = self.env.cr.precommit.data.get(ANALYSIS_DIRTY_KEY)
+        if not dirty:
+            return
+        groups = dirty['groups'] | self._get_line_groups(dirty['line_ids'])
+        dirty['line_ids'].clear()
+        dirty['groups'].clear()
+        self._refresh_groups(groups)
+
+    @api.model
+    def _get_line_groups(self, line_ids):
+        """Groups (product_id, user_id or 0, month, company_id) of order lines"""
+        self.env['sale.order.line'].flush_model(['order_id', 'product_id'])
+        self.env['sale.order'].flush_model(['user_id', 'date_order', 'company_id'])
+        groups = set()
+        for chunk_ids in split_every(ANALYSIS_REFRESH_CHUNK_SIZE * 10, list(line_ids), tuple):
+            self.env.cr.execute(SQL(
+                """
+                SELECT DISTINCT line.product_id, COALESCE(so.user_id, 0),
+                       date_trunc('month', so.date_order)::date, so.company_id
+                  FROM sale_order_line line
+                  JOIN sale_order so ON so.id = line.order_id
+                 WHERE line.id IN %s
+                   AND line.product_id IS NOT NULL
+                """,
+                chunk_ids,
+            ))
+            groups.update(self.env.cr.fetchall())
+        return groups
+
+    @api.model
+    def _refresh_groups(self, groups):
+        """
+        Recompute the rows of the given groups from the order lines: rows of
+        groups that still have lines are upserted on the group key, the
+        others deleted. Concurrent refreshes of a group thus never leave
+        duplicate rows behind.
+        """
+        if not groups:
+            return
+        self.env.flush_all()
+        for chunk in split_every(ANALYSIS_REFRESH_CHUNK_SIZE, list(groups), tuple):
+            self.env.cr.execute(SQL(
+                """
+                WITH refreshed AS (%s
+                    ON CONFLICT (product_id, COALESCE(user_id, 0), date, company_id) DO UPDATE
+                   SET categ_id = EXCLUDED.categ_id,
+                       user_id = EXCLUDED.user_id,
+                       line_count = EXCLUDED.line_count,
+                       product_uom_qty = EXCLUDED.product_uom_qty,
+                       cost_total = EXCLUDED.cost_total,
+                       revenue_total = EXCLUDED.revenue_total,
+                       margin_total = EXCLUDED.margin_total
+             RETURNING id
+                )
+                DELETE FROM sale_margin_analysis
+                 WHERE (product_id, COALESCE(user_id, 0), date, company_id) IN %s
+                   AND id NOT IN (SELECT id FROM refreshed)
+                """,
+                self._get_aggregate_insert_query(SQL(
+                    "(line.product_id, COALESCE(so.user_id, 0), date_trunc('month', so.date_order)::date, so.company_id) IN %s",
+                    chunk,
+                )),
+                chunk,
+            ))
+        self.invalidate_model()
+
+    @api.model
+    def _get_aggregate_insert_query(self, where):
+        """
+        INSERT of the aggregated rows of the lines matching where. The cost
+        of a line is its subtotal minus its margin_amount, i.e. its cost
+        converted to the line UoM, times its quantity.
+        """
+        return SQL(
+            """
+            INSERT INTO sale_margin_analysis (
+                date, product_id, categ_id, user_id, company_id,
+                line_count, product_uom_qty, cost_total, revenue_total, margin_total
+            )
+            SELECT date, product_id, categ_id, user_id, company_id,
+                   COUNT(*), SUM(qty), SUM(revenue - margin), SUM(revenue), SUM(margin)
+              FROM (
+                SELECT date_trunc('month', so.date_order)::date AS date,
+                       line.product_id,
+                       pt.categ_id,
+                       so.user_id,
+                       so.company_id,
+                       COALESCE(line.product_uom_qty, 0.0) AS qty,
+                       COALESCE(line.price_subtotal, 0.0) / COALESCE(NULLIF(so.currency_rate, 0.0), 1.0) AS revenue,
+                       COALESCE(line.margin_amount, line.price_subtotal, 0.0) / COALESCE(NULLIF(so.currency_rate, 0.0), 1.0) AS margin
+                  FROM sale_order_line line
+                  JOIN sale_order so ON so.id = line.order_id
+                  JOIN product_product pp ON pp.id = line.product_id
+                  JOIN product_template pt ON pt.id = pp.product_tmpl_id
+                 WHERE so.state != 'cancel'
+                   AND line.display_type IS NULL
+                   AND %s
+              ) AS lines
+          GROUP BY date, product_id, categ_id, user_id, company_id
+            """,
+            where,
+        )
+
+    # ------------------------------------------------------------------
+    # Reconciliation
+    # ------------------------------------------------------------------
+
+    @api.model
+    def _rebuild(self):
+        """Recompute the whole table from scratch"""
+        self.env.flush_all()
+        self.env.cr.execute(SQL("DELETE FROM sale_margin_analysis"))
+        self.env.cr.execute(self._get_aggregate_insert_query(SQL("TRUE")))
+        self.invalidate_model()
+
+    @api.model
+    def _cron_reconcile(self):
+        """
+        Refresh the groups of the lines and orders written since the last
+        run (e.g. by SQL updates bypassing the ORM). Builds the whole table
+        on the first run.
+
+        The new watermark is the start of this transaction, the write_date
+        of its own writes. As other transactions still open may commit
+        writes dated before it, each run reads back ANALYSIS_RECONCILE_OVERLAP
+        before the watermark; refreshing a group twice is harmless.
+        """
+        ICP = self.env['ir.config_parameter'].sudo()
+        watermark = ICP.get_param(ANALYSIS_WATERMARK_PARAM)
+        self.env.cr.execute(SQL("SELECT (transaction_timestamp() AT TIME ZONE 'UTC')::timestamp"))
+        new_watermark = self.env.cr.fetchone()[0]
+
+        if not watermark:
+            self._rebuild()
+        else:
+            self.env.cr.execute(SQL(
+                """
+                SELECT line.id
+                  FROM sale_order_line line
+                 WHERE line.write_date > %(watermark)s
+                 UNION
+                SELECT line.id
+                  FROM sale_order so
+                  JOIN sale_order_line line ON line.order_id = so.id
+                 WHERE so.write_date > %(watermark)s
+                """,
+                watermark=fields.Datetime.to_datetime(watermark) - ANALYSIS_RECONCILE_OVERLAP,
+            ))
+            line_ids = [row[0] for row in self.env.cr.fetchall()]
+            groups = self._get_line_groups(line_ids)
+            self._refresh_groups(groups)
+            _logger.info("Margin analysis: reconciled %s lines, %s groups", len(line_ids), len(groups))
+
+        ICP.set_param(ANALYSIS_WATERMARK_PARAM, fields.Datetime.to_string(new_watermark))
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict
+
+from odoo import models, fields, api, tools
+from odoo.tools import SQL
+
+# Margin applied to a line when no rule matches
+DEFAULT_MARGIN_PERCENT = 20.0
+
+
+class SaleMarginRule(models.Model):
+    """
+    Margin rule: the margin_percent given to new order lines matching its
+    criteria (product, product category and its sub-categories, customer,
+    pricelist, date range). Unset criteria match everything.
+
+    When several rules match a line, the most specific one wins: product
+    rules first, then category rules from the closest category up to the
+    root, then rules without product nor category. Within each level,
+    rules with more customer/pricelist/date criteria come first, then by
+    sequence.
+    """
+    _name = 'sale.margin.rule'
+    _description = 'Sale Margin Rule'
+    _order = 'sequence, id'
+
+    name = fields.Char(string='Name', required=True)
+    active = fields.Boolean(default=True)
+    sequence = fields.Integer(default=10)
+    company_id = fields.Many2one(
+        'res.company',
+        string='Company',
+        default=lambda self: self.env.company,
+        help='Leave empty to apply the rule in all companies'
+    )
+    margin_percent = fields.Float(
+        string='Margin %',
+        required=True,
+        default=DEFAULT_MARGIN_PERCENT,
+        help='Margin percentage given to matching order lines'
+    )
+    product_id = fields.Many2one('product.product', string='Product', ondelete='cascade')
+    categ_id = fields.Many2one(
+        'product.category',
+        string='Product Category',
+        ondelete='cascade',
+        help='The rule also applies to the sub-categories'
+    )
+    partner_id = fields.Many2one(
+        'res.partner',
+        string='Customer',
+        ondelete='cascade',
+        help='The rule applies to the orders of this customer and its contacts'
+    )
+    pricelist_id = fields.Many2one('product.pricelist', string='Pricelist', ondelete='cascade')
+    date_start = fields.Date(string='Start Date', help='Based on the order date')
+    date_end = fields.Date(string='End Date', help='Based on the order date')
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        rules = super(SaleMarginRule, self).create(vals_list)
+        rules._bump_rule_version()
+        return rules
+
+    def write(self, vals):
+        companies = self.company_id
+        shared = not all(rule.company_id for rule in self)
+        res = super(SaleMarginRule, self).write(vals)
+        self._bump_rule_version(companies, shared)
+        return res
+
+    def unlink(self):
+        companies = self.company_id
+        shared = not all(rule.company_id for rule in self)
+        res = super(SaleMarginRule, self).unlink()
+        self.browse()._bump_rule_version(companies, shared)
+        return res
+
+    def _bump_rule_version(self, companies=None, shared=False):
+        """
+        Invalidate the cached rule index of the companies these rules apply
+        to, plus the given companies (e.g. the ones before a write), or of
+        all companies when one of the rules is shared.
+
+        Only the index of these companies is rebuilt, on its next use; the
+        rest of the registry cache is left alone. The version lives in the
+        database, so other workers see the change once it is committed.
+        """
+        companies = (companies or self.env['res.company']) | self.sudo().company_id
+        shared = shared or not all(rule.company_id for rule in self.sudo())
+        if not companies and not shared:
+            return
+        where = SQL("TRUE") if shared else SQL("id IN %s", tuple(companies.ids))
+        self.env.cr.execute(SQL(
+            "UPDATE res_company SET margin_rule_version = COALESCE(margin_rule_version, 0) + 1 WHERE %s",
+            where,
+        ))
+        self.env['res.company'].invalidate_model(['margin_rule_version'])
+
+    @api.model
+    def _get_rule_index(self, company_id):
+        """
+        Resolution index of the active rules of a company, see
+        _get_versioned_rule_index.
+        """
+        company = self.env['res.company'].browse(company_id)
+        return self._get_versioned_rule_index(company_id, company.sudo().margin_rule_version)
+
+    @api.model
+    @tools.ormcache('company_id', 'version')
+    def _get_versioned_rule_index(self, company_id, version):
+        """
+        Resolution index of the active rules of a company, built once per
+        version of its rules and kept in the registry cache. A rule change
+        bumps the version of the companies concerned, so their next lookup
+        misses the cache and rebuilds only their index.
+
+        :return: dict {anchor: tuple of rules} where anchor is
+            ('product', product_id), ('categ', categ_id) or None, and each rule
+            is a tuple (margin_percent, categ_id, partner_id, pricelist_id,
+            date_start, date_end), sorted by priority within its anchor
+        """
+        rules = self.sudo().with_context(active_test=True).search([
+            ('company_id', 'in', (company_id, False)),
+        ])
+        index = defaultdict(list)
+        for rule in rules:
+            if rule.product_id:
+                anchor = ('product', rule.product_id.id)
+            elif rule.categ_id:
+                anchor = ('categ', rule.categ_id.id)
+            else:
+                anchor = None
+            specificity = bool(rule.partner_id) + bool(rule.pricelist_id) + bool(rule.date_start or rule.date_end)
+            index[anchor].append((
+                (-specificity, rule.sequence, rule.id),
+                (
+                    rule.margin_percent,
+                    rule.categ_id.id,
+                    rule.partner_id.id,
+                    rule.pricelist_id.id,
+                    rule.date_start,
+                    rule.date_end,
+                ),
+            ))
+        return {
+            anchor: tuple(rule for _priority, rule in sorted(anchor_rules))
+            for anchor, anchor_rules in index.items()
+        }
+
+    @api.model
+    def _resolve_margin_percents(self, items, company=None):
+        """
+        Resolve the margin of many order lines at once.
+
+        Products, their category chains and the customers' commercial
+        entities are read in bulk; matching itself only uses the cached
+        resolution index.
+
+        :param items: list of (product_id, partner_id, pricelist_id, date)
+        :param company: res.company record, defaults to the current company
+        :return: list of margin percentages, None where no rule matches
+        """
+        company = company or self.env.company
+        index = self._get_rule_index(company.id)
+        if not index:
+            return [None] * len(items)
+
+        products = self.env['product.product'].browse(list({item[0] for item in items if item[0]}))
+        # Closest category first: parent_path is "root/.../categ/"
+        categ_chains = {
+            product.id: [int(categ_id) for categ_id in reversed(product.categ_id.parent_path.split('/')[:-1])]
+            if product.categ_id.parent_path else []
+            for product in products
+        }
+        partners = self.env['res.partner'].browse(list({item[1] for item in items if item[1]}))
+        commercial_partners = {partner.id: partner.commercial_partner_id.id for partner in partners}
+
+        memo = {}
+        margins = []
+        for item in items:
+            if item not in memo:
+                product_id, partner_id, pricelist_id, date = item
+                memo[item] = self._match_rule(
+                    index,
+                    product_id,
+                    categ_chains.get(product_id, []),
+                    {partner_id, commercial_partners.get(partner_id)} - {None, False},
+                    pricelist_id,
+                    date,
+                )
+            margins.append(memo[item])
+        return margins
+
+    @api.model
+    def _match_rule(self, index, product_id, categ_chain, partner_ids, pricelist_id, date):
+        """Margin of the first rule of index matching the criteria, or None"""
+        candidates = [index.get(('product', product_id), ())]
+        candidates += [index.get(('categ', categ_id), ()) for categ_id in categ_chain]
+        candidates.append(index.get(None, ()))
+        for anchor_rules in candidates:
+            for margin_percent, categ_id, partner_id, rule_pricelist_id, date_start, date_end in anchor_rules:
+                if categ_id and categ_id not in categ_chain:
+                    continue
+                if partner_id and partner_id not in partner_ids:
+                    continue
+                if rule_pricelist_id and rule_pricelist_id != pricelist_id:
+                    continue
+                if date_start and (not date or date < date_start):
+                    continue
+                if date_end and (not date or date > date_end):
+                    continue
+                return margin_percent
+        return None
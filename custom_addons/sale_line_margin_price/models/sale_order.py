@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+
+from .sale_margin_rule import DEFAULT_MARGIN_PERCENT
+
+# sale.order fields that move order lines between margin analysis groups
+MARGIN_ANALYSIS_ORDER_FIELDS = ('user_id', 'date_order', 'company_id', 'state', 'currency_rate')
+
+
+class SaleOrder(models.Model):
+    _inherit = 'sale.order'
+
+    def write(self, vals):
+        """
+        Override write to refresh the margin analysis of the order lines
+        when a field their group or amounts depend on changes.
+        """
+        if any(field in vals for field in MARGIN_ANALYSIS_ORDER_FIELDS):
+            self.env['sale.margin.analysis']._mark_lines_dirty(self.order_line.ids, capture_old_groups=True)
+        return super(SaleOrder, self).write(vals)
+
+    def unlink(self):
+        # Lines are deleted by the database cascade, not by their unlink()
+        self.env['sale.margin.analysis']._mark_lines_dirty(self.order_line.ids, capture_old_groups=True)
+        return super(SaleOrder, self).unlink()
+
+    def action_confirm(self):
+        """Freeze the cost of the lines of the confirmed orders, see sale.order.line._snapshot_confirmed_costs"""
+        quotations = self.filtered(lambda order: order.state in ('draft', 'sent'))
+        res = super(SaleOrder, self).action_confirm()
+        quotations.filtered(lambda order: order.state == 'sale').order_line._snapshot_confirmed_costs()
+        return res
+
+    def action_draft(self):
+        res = super(SaleOrder, self).action_draft()
+        self.filtered(lambda order: order.state == 'draft').order_line._clear_confirmed_costs()
+        return res
+
+    @api.onchange('sale_order_template_id')
+    def _onchange_sale_order_template_id(self):
+        """
+        Price the lines of the quotation template at their margin, all at
+        once with a single cost lookup, instead of the pricelist price they
+        get from the standard onchange. Lines of template lines without a
+        margin of their own get the margin of the matching margin rule, like
+        on create.
+        """
+        res = super(SaleOrder, self)._onchange_sale_order_template_id()
+        if self.sale_order_template_id and self.state in ('draft', 'sent'):
+            # The standard onchange creates one line per template line, in order
+            template_lines = self.sale_order_template_id.sale_order_template_line_ids
+            self._set_template_rule_margins(self.env['sale.order.line'].concat(*(
+                line for line, template_line in zip(self.order_line, template_lines)
+                if line.product_id and not template_line.display_type and template_line.use_margin_rule
+            )))
+            lines = self.order_line.filtered(lambda line: line.product_id and not line.display_type)
+            costs, prices = lines._get_margin_prices()
+            for line, cost, price_unit in zip(lines, costs, prices):
+                # Like on create, zero-cost products keep the standard price
+                if cost:
+                    line.price_unit = price_unit
+                    line.margin_price_manual = False
+        return res
+
+    def _set_template_rule_margins(self, lines):
+        """Set the margin of the matching margin rule, resolved at once, on lines of this order"""
+        if not lines:
+            return
+        date = fields.Date.to_date(self.date_order) or fields.Date.context_today(self)
+        margins = self.env['sale.margin.rule']._resolve_margin_percents(
+            [(line.product_id.id, self.partner_id.id, self.pricelist_id.id, date) for line in lines],
+            self.company_id or self.env.company,
+        )
+        for line, margin_percent in zip(lines, margins):
+            line.margin_percent = DEFAULT_MARGIN_PERCENT if margin_percent is None else margin_percent
+
+    def _apply_margin_template(self, template=None):
+        """
+        Replace the lines of the quotations of self by the lines of template
+        (default: their own quotation template), created in a single batch
+        priced at the template line margins (see sale.order.line.create).
+        Quotations without template are left alone.
+
+        :return: the created sale.order.line records
+        """
+        orders = self if template else self.filtered('sale_order_template_id')
+        if any(order.state not in ('draft', 'sent') for order in orders):
+            raise UserError(_("Quotation templates can only be applied to quotations."))
+        vals_list = []
+        for order in orders:
+            order_template = (template or order.sale_order_template_id).with_context(lang=order.partner_id.lang)
+            vals_list += [
+                dict(line._prepare_order_line_values(), order_id=order.id)
+                for line in order_template.sale_order_template_line_ids
+            ]
+        orders.order_line.unlink()
+        return self.env['sale.order.line'].create(vals_list)
+
+    def _get_margin_totals(self, lines=None):
+        """
+        Revenue and cost of the lines of this order, in the order currency,
+        with the costs the margin applies to.
+
+        :return: tuple (revenue, cost)
+        """
+        self.ensure_one()
+        if lines is None:
+            lines = self.order_line.filtered(lambda line: not line.display_type)
+        revenue = cost = 0.0
+        for line, unit_cost in zip(lines, lines._get_margin_costs()):
+            revenue += line.price_unit * line.product_uom_qty * (1.0 - (line.discount or 0.0) / 100.0)
+            cost += unit_cost * line.product_uom_qty
+        return revenue, cost
+
+    def _get_overall_margin_percent(self):
+        """Margin of the whole order on its cost, in the unit of margin_percent"""
+        revenue, cost = self._get_margin_totals()
+        return (revenue / cost - 1.0) * 100.0 if cost else 0.0
+
+    def apply_target_margin(self, target_margin, locked_lines=None, method='uniform', margin_rounding=0.0):
+        """
+        Set the margin of the lines of this quotation so that its overall
+        margin reaches target_margin (on cost, like margin_percent).
+
+        The margins are solved for all lines at once and written back with
+        their margin prices in a single statement. Only available in the
+        'margin' pricelist mode: the solver assumes the price of a line is
+        its margin price, which the pricelist modes combine with the
+        pricelist price.
+
+        :param target_margin: overall margin to reach (25.0 for 25%)
+        :param locked_lines: sale.order.line records whose price must not
+            change. Lines without cost or quantity are locked too
+        :param method: 'uniform' or 'shift', see the pricing service's
+            _solve_target_margins
+        :param margin_rounding: step the solved margins are rounded to
+        :return: dict with the overall margin reached and the number of
+            repriced lines
+        """
+        self.ensure_one()
+        self.check_access('write')
+        if self.state not in ('draft', 'sent'):
+            raise UserError(_("Only the margin of quotations can be changed."))
+        if self.env['sale.line.margin.pricing']._get_pricelist_mode() != 'margin':
+            raise UserError(_("Target margins cannot be applied while margin prices are combined with pricelist prices."))
+
+        lines = self.order_line.filtered(lambda line: not line.display_type)
+        locked_ids = set((locked_lines or self.env['sale.order.line']).ids)
+        unit_costs = lines._get_margin_costs()
+
+        free_ids = []
+        free_costs = []
+        weights = []
+        margins = []
+        locked_revenue = total_cost = 0.0
+        for line, unit_cost in zip(lines, unit_costs):
+            discount_factor = 1.0 - (line.discount or 0.0) / 100.0
+            weight = unit_cost * line.product_uom_qty * discount_factor
+            total_cost += unit_cost * line.product_uom_qty
+            if line.id in locked_ids or not weight:
+                locked_revenue += line.price_unit * line.product_uom_qty * discount_factor
+                continue
+            free_ids.append(line.id)
+            free_costs.append(unit_cost)
+            weights.append(weight)
+            margins.append(line.margin_percent)
+
+        if not free_ids:
+            raise UserError(_("There are no lines left to reach the target margin with."))
+
+        solved = self.env['sale.line.margin.pricing']._solve_target_margins(
+            weights, margins,
+            (1.0 + target_margin / 100.0) * total_cost - locked_revenue,
+            method=method,
+            margin_rounding=margin_rounding,
+        )
+        self.env['sale.order.line'].browse(free_ids)._write_margin_prices(solved, free_costs)
+        return {
+            'margin': self._get_overall_margin_percent(),
+            'lines': len(free_ids),
+        }
@@ -1,6 +1,31 @@
 # -*- coding: utf-8 -*-
 
+from collections import defaultdict
+
 from odoo import models, fields, api
+from odoo.tools import SQL, create_index, float_compare, split_every, str2bool
+
+from ..tools import instrumented
+from .sale_margin_rule import DEFAULT_MARGIN_PERCENT
+
+# Number of lines updated per statement when propagating a product cost change
+COST_PROPAGATION_CHUNK_SIZE = 10000
+
+# System parameter selecting how price_unit follows the margin:
+# 'onchange' (default): onchanges plus create/write overrides
+# 'compute': a batched compute of the stored price_unit
+PRICE_MODE_PARAM = 'sale_line_margin_price.price_mode'
+
+# Rows fetched per round trip by the margin export, and its columns
+MARGIN_EXPORT_BATCH_SIZE = 2000
+MARGIN_EXPORT_COLUMNS = (
+    'Order', 'Order Date', 'Status', 'Salesperson', 'Product', 'Quantity',
+    'Cost', 'Margin %', 'Unit Price', 'Subtotal', 'Margin', 'Currency',
+)
+
+# System parameter ('1'/'True') switching margin-only writes to the
+# concurrent update mode, see _write_margin_percent_concurrent
+CONCURRENT_UPDATES_PARAM = 'sale_line_margin_price.concurrent_updates'
 
 
 class SaleOrderLine(models.Model):
@@ -8,8 +33,10 @@ class SaleOrderLine(models.Model):
 
     margin_percent = fields.Float(
         string='Margin %',
-        default=20.0,  # Default 20%
-        help='Margin percentage applied to product cost to calculate selling price'
+        default=DEFAULT_MARGIN_PERCENT,
+        index=True,
+        help='Margin percentage applied to product cost to calculate selling price. '
+             'New lines get the margin of the matching margin rule, if any'
     )
 
     cost_price = fields.Float(
@@ -17,9 +44,50 @@ class SaleOrderLine(models.Model):
         compute='_compute_cost_price',
         store=True,
         readonly=True,
+        index=True,
         help='Product standard cost price (for visibility)'
     )
 
+    confirmed_cost_price = fields.Float(
+        string='Confirmed Cost Price',
+        readonly=True,
+        copy=False,
+        help='Cost price of the line when its order was confirmed. Margins of confirmed '
+             'orders are computed from it, whatever the later product costs'
+    )
+
+    cost_confirmed = fields.Boolean(
+        string='Cost Confirmed',
+        readonly=True,
+        copy=False,
+        help='Set when the cost of the line was frozen in Confirmed Cost Price, '
+             'which may legitimately be zero'
+    )
+
+    margin_unit_cost = fields.Float(
+        string='Margin Cost',
+        compute='_compute_margin_unit_cost',
+        digits='Product Price',
+        help='Unit cost the margin applies to, in the order currency and the line UoM'
+    )
+
+    margin_amount = fields.Float(
+        string='Margin Amount',
+        compute='_compute_margin_amount',
+        store=True,
+        precompute=True,
+        index=True,
+        digits='Product Price',
+        help='Subtotal minus the cost of the line, in the order currency'
+    )
+
+    margin_price_manual = fields.Boolean(
+        string='Manual Price',
+        copy=False,
+        help='Set when the unit price was entered by hand: in computed price mode, '
+             'the margin no longer drives it until the margin or product changes'
+    )
+
     @api.depends('product_id')
     def _compute_cost_price(self):
         """Compute the cost price from product standard_price"""
@@ -29,7 +97,76 @@ class SaleOrderLine(models.Model):
             else:
                 line.cost_price = 0.0
 
+    def init(self):
+        super().init()
+        # Margin reviews filter the open quotations by margin
+        create_index(
+            self.env.cr, 'sale_order_line_quotation_margin_percent_index', self._table,
+            ['margin_percent'], where="state IN ('draft', 'sent')",
+        )
+
+    @api.depends('cost_price', 'cost_confirmed', 'confirmed_cost_price', 'product_uom_id', 'order_id.currency_id', 'order_id.date_order')
+    def _compute_margin_unit_cost(self):
+        """
+        Cost converted to the order currency and the line UoM: the cost at
+        confirmation for lines of confirmed orders, cost_price otherwise
+        """
+        factors = self.env['sale.line.margin.pricing']._get_cost_conversion_factors(
+            self._get_margin_conversion_items(),
+        )
+        for line, factor in zip(self, factors):
+            cost = line.confirmed_cost_price if line.cost_confirmed else line.cost_price
+            line.margin_unit_cost = cost * factor
+
+    @api.depends('price_subtotal', 'margin_unit_cost', 'product_uom_qty')
+    def _compute_margin_amount(self):
+        """Margin of the line: subtotal minus the converted cost of its quantity"""
+        for line in self:
+            line.margin_amount = line.price_subtotal - line.margin_unit_cost * line.product_uom_qty
+
+    @api.model
+    def _is_margin_compute_mode(self):
+        """Whether price_unit is driven by _compute_price_unit (see PRICE_MODE_PARAM)"""
+        return self.env['ir.config_parameter'].sudo().get_param(PRICE_MODE_PARAM) == 'compute'
+
+    @api.model
+    def _is_margin_concurrent_mode(self):
+        """Whether margin-only writes use the concurrent update mode (see CONCURRENT_UPDATES_PARAM)"""
+        return str2bool(self.env['ir.config_parameter'].sudo().get_param(CONCURRENT_UPDATES_PARAM) or False)
+
+    def _compute_price_unit(self):
+        """
+        In computed price mode, price_unit of quotation lines is the margin
+        price, computed in batch for all lines (precomputed on create).
+        Lines whose price was entered by hand keep the standard price.
+
+        The margin is deliberately not a dependency, which would apply in
+        every price mode: margin changes are repriced by write() and the
+        margin onchange. The order state is not one either: confirming an
+        order must never recompute its prices.
+        """
+        if not self._is_margin_compute_mode():
+            return super(SaleOrderLine, self)._compute_price_unit()
+
+        # Prices entered by hand survive the standard recomputation too
+        manual_prices = {line: line.price_unit for line in self if line.margin_price_manual}
+        super(SaleOrderLine, self)._compute_price_unit()
+        for line, price_unit in manual_prices.items():
+            line.price_unit = price_unit
+
+        lines = self.filtered(lambda line: (
+            line.product_id
+            and not line.margin_price_manual
+            and (not line.order_id or line.order_id.state in ('draft', 'sent'))
+        ))
+        costs, prices = lines._get_margin_prices()
+        for line, cost, price_unit in zip(lines, costs, prices):
+            # Like on create, zero-cost products keep the standard price
+            if cost:
+                line.price_unit = price_unit
+
     @api.onchange('margin_percent')
+    @instrumented('onchange_margin_percent')
     def _onchange_margin_percent(self):
         """
         Auto-update price_unit when margin changes.
@@ -42,20 +179,31 @@ class SaleOrderLine(models.Model):
             return
 
         if self.product_id:
-            cost = self.product_id.standard_price or 0.0
-
             # margin_percent is stored as number: 100 for 100%, 50 for 50%, 20 for 20%
-            margin_multiplier = 1.0 + (self.margin_percent / 100.0)
-            new_price = cost * margin_multiplier
-
-            self.price_unit = new_price
+            self.price_unit = self._get_margin_prices()[1][0]
+            self.margin_price_manual = False
 
     @api.onchange('product_id')
+    @instrumented('onchange_product_id')
     def _onchange_product_id_margin(self):
         """
         Auto-update price_unit when product changes.
         This runs AFTER the standard product_id onchange.
         """
+        # In computed price mode _compute_price_unit prices the product with
+        # the margin it had, reprice it with the margin of the rule
+        if self._is_margin_compute_mode():
+            if self.product_id and (not self.order_id or self.order_id.state in ('draft', 'sent')):
+                margin_percent = self._get_rule_margin_percent()
+                if margin_percent is not None and margin_percent != self.margin_percent:
+                    self.margin_percent = margin_percent
+                    costs, prices = self._get_margin_prices()
+                    # Like _compute_price_unit, zero-cost products keep the standard price
+                    if costs[0]:
+                        self.price_unit = prices[0]
+                        self.margin_price_manual = False
+            return
+
         # Call parent onchange first
         res = super(SaleOrderLine, self)._onchange_product_id()
 
@@ -64,13 +212,16 @@ class SaleOrderLine(models.Model):
 
         # Then override price with margin-based calculation
         if self.product_id:
-            cost = self.product_id.standard_price or 0.0
-            margin_multiplier = 1.0 + (self.margin_percent / 100.0)
-            self.price_unit = cost * margin_multiplier
+            margin_percent = self._get_rule_margin_percent()
+            if margin_percent is not None:
+                self.margin_percent = margin_percent
+            self.price_unit = self._get_margin_prices()[1][0]
+            self.margin_price_manual = False
 
         return res
 
     @api.model_create_multi
+    @instrumented('create', count_records=lambda self, vals_list: len(vals_list))
     def create(self, vals_list):
         """
         Override create to recompute price_unit from margin on new lines
@@ -78,66 +229,705 @@ class SaleOrderLine(models.Model):
         Only applies in draft/sent states.
         Note: margin_percent is stored as number (20.0 for 20%, 100.0 for 100%)
         """
+        if self._is_margin_compute_mode():
+            self._prepare_margin_compute_vals(vals_list)
+        else:
+            self._prepare_margin_price_vals(vals_list)
+        lines = super(SaleOrderLine, self).create(vals_list)
+        self.env['sale.margin.analysis']._mark_lines_dirty(lines.ids)
+        return lines
+
+    @api.model
+    def _prepare_margin_compute_vals(self, vals_list):
+        """
+        Computed price mode counterpart of _prepare_margin_price_vals:
+        price_unit is precomputed by _compute_price_unit, only the rule
+        margins and the manual price flag are set on vals_list.
+        """
+        order_ids = list({vals['order_id'] for vals in vals_list if vals.get('order_id')})
+        orders = {order.id: order for order in self.env['sale.order'].browse(order_ids)}
+        self._set_rule_margin_vals(vals_list, {order_id: order.company_id for order_id, order in orders.items()})
+        self._set_manual_price_vals(vals_list, orders)
+        return vals_list
+
+    @api.model
+    def _set_manual_price_vals(self, vals_list, orders):
+        """
+        Flag the vals of vals_list that carry a price_unit entered by hand
+        (see margin_price_manual), unless they set the flag themselves.
+
+        The web client sends the price the onchanges computed without the
+        flag, which it only sends when it changes: a price is thus manual
+        only when it differs from the margin price of its vals. Prices of
+        zero-cost products are the standard price, not manual either.
+
+        :param dict orders: {order_id: sale.order} of the orders of vals_list
+        """
+        if self.env.context.get('margin_price_auto'):
+            return
+        to_check = [vals for vals in vals_list if 'price_unit' in vals and 'margin_price_manual' not in vals]
+        product_vals = [vals for vals in to_check if vals.get('product_id')]
+        price_digits = self.env['decimal.precision'].precision_get('Product Price')
+        margin_prices = iter(self._get_vals_margin_prices(product_vals, orders))
+        for vals in to_check:
+            if not vals.get('product_id'):
+                vals['margin_price_manual'] = True
+                continue
+            price_unit = next(margin_prices)
+            vals['margin_price_manual'] = price_unit is not None and bool(
+                float_compare(price_unit, vals['price_unit'], precision_digits=price_digits)
+            )
+
+    def _write_price_unit(self, vals):
+        """
+        write() of vals setting price_unit, with margin_price_manual set as
+        on create: the price is manual on the lines where it differs from
+        their margin price for vals, unless vals sets the flag itself.
+        """
+        if 'margin_price_manual' in vals:
+            return super(SaleOrderLine, self).write(vals)
+        if self.env.context.get('margin_price_auto'):
+            return super(SaleOrderLine, self).write(dict(vals, margin_price_manual=False))
+        margin_lines = self._filter_margin_price(vals)
+        manual_lines = self - margin_lines
+        if margin_lines:
+            super(SaleOrderLine, margin_lines).write(dict(vals, margin_price_manual=False))
+        if manual_lines:
+            super(SaleOrderLine, manual_lines).write(dict(vals, margin_price_manual=True))
+        return True
+
+    def _filter_margin_price(self, vals):
+        """
+        Lines of self whose price_unit in vals is their margin price once
+        vals is written, or the standard price of a zero-cost product
+        """
+        price_digits = self.env['decimal.precision'].precision_get('Product Price')
+        new_product = 'product_id' in vals and self.env['product.product'].browse(vals['product_id'])
+        new_uom = 'product_uom_id' in vals and self.env['uom.uom'].browse(vals['product_uom_id'])
+        if new_product is False:
+            lines = self.filtered('product_id')
+        else:
+            lines = self if new_product else self.browse()
+        costs, prices = lines._get_margin_prices(
+            margins=[vals.get('margin_percent', line.margin_percent) for line in lines],
+            product=None if new_product is False else new_product,
+            uom=None if new_uom is False else new_uom,
+        )
+        return self.browse([
+            line.id for line, cost, price_unit in zip(lines, costs, prices)
+            if not cost or not float_compare(price_unit, vals['price_unit'], precision_digits=price_digits)
+        ])
+
+    @api.model
+    def _prepare_margin_price_vals(self, vals_list):
+        """
+        Set the margin-based price_unit on every vals dict of vals_list that
+        should be auto-priced (see _should_auto_compute_price), and the
+        margin of the matching margin rule on the vals without margin_percent.
+
+        All orders referenced by vals_list are browsed together and product
+        costs go through the pricing service cache, so standard_price and
+        order state are each read in a single query whatever the size of
+        vals_list (EDI imports create thousands of lines in one call).
+        """
+        order_ids = list({vals['order_id'] for vals in vals_list if vals.get('order_id')})
+
+        # Iterating a browsed recordset prefetches the fields for all its records
+        order_states = {}
+        order_companies = {}
+        orders = {}
+        for order in self.env['sale.order'].browse(order_ids):
+            order_states[order.id] = order.state
+            order_companies[order.id] = order.company_id
+            orders[order.id] = order
+
+        self._set_rule_margin_vals(vals_list, order_companies)
+        self._set_manual_price_vals(vals_list, orders)
+
+        # Check if we should auto-compute price
+        to_price = [
+            vals for vals in vals_list
+            if self._should_auto_compute_price(vals, order_states=order_states)
+        ]
+        for vals, price_unit in zip(to_price, self._get_vals_margin_prices(to_price, orders)):
+            if price_unit is not None:
+                vals['price_unit'] = price_unit
+
+        return vals_list
+
+    @api.model
+    def _get_vals_margin_prices(self, vals_list, orders):
+        """
+        Margin prices of the lines to create from vals_list, which all have
+        a product and a margin. Costs are converted to the order currency
+        and the line UoM, and the prices combined with the order pricelist
+        (see PRICELIST_MODE_PARAM).
+
+        :param dict orders: {order_id: sale.order} of the orders of vals_list
+        :return: list of prices aligned with vals_list, None for zero-cost
+            products, which keep the standard price
+        """
+        if not vals_list:
+            return []
+        pricing = self.env['sale.line.margin.pricing']
+        order_companies = {order_id: order.company_id for order_id, order in orders.items()}
+
+        product_ids_by_company = defaultdict(set)
         for vals in vals_list:
-            # Check if we should auto-compute price
-            if self._should_auto_compute_price(vals):
-                product = self.env['product.product'].browse(vals.get('product_id'))
-                margin_percent = vals.get('margin_percent', 20.0)  # Default 20%
+            company = order_companies.get(vals.get('order_id')) or self.env.company
+            product_ids_by_company[company].add(vals['product_id'])
+        costs = {
+            company: pricing._get_costs(self.env['product.product'].browse(list(product_ids)), company)
+            for company, product_ids in product_ids_by_company.items()
+        }
+
+        products = {
+            product.id: product
+            for product in self.env['product.product'].browse(list({vals['product_id'] for vals in vals_list}))
+        }
+        Uom = self.env['uom.uom']
+        priced_indexes = []
+        priced_vals = []
+        line_costs = []
+        conversion_items = []
+        pricelist_items = []
+        for index, vals in enumerate(vals_list):
+            company = order_companies.get(vals.get('order_id')) or self.env.company
+            cost = costs[company].get(vals['product_id'])
+            if cost:
+                order = orders.get(vals.get('order_id'), self.env['sale.order'])
+                product = products[vals['product_id']]
+                uom = Uom.browse(vals.get('product_uom_id'))
+                priced_indexes.append(index)
+                priced_vals.append(vals)
+                line_costs.append(cost)
+                conversion_items.append((product, company, order.currency_id, uom, order.date_order))
+                pricelist_items.append((
+                    order.pricelist_id, product, company, order.currency_id, uom,
+                    vals.get('product_uom_qty', 1.0), order.date_order,
+                ))
+
+        factors = pricing._get_cost_conversion_factors(conversion_items)
+        line_costs = [cost * factor for cost, factor in zip(line_costs, factors)]
+        prices = pricing._compute_line_prices(
+            line_costs,
+            [vals.get('margin_percent', DEFAULT_MARGIN_PERCENT) for vals in priced_vals],
+            self._get_price_unit_rounding(),
+            pricelist_items,
+        )
+        margin_prices = [None] * len(vals_list)
+        for index, price_unit in zip(priced_indexes, prices):
+            margin_prices[index] = price_unit
+        return margin_prices
+
+    @api.model
+    def _set_rule_margin_vals(self, vals_list, order_companies):
+        """
+        Set margin_percent from the margin rules on the vals of vals_list
+        that have a product but no explicit margin, resolving them all at
+        once per company.
+
+        :param dict order_companies: {order_id: company} of the orders of vals_list
+        """
+        vals_by_company = defaultdict(list)
+        for vals in vals_list:
+            if vals.get('product_id') and 'margin_percent' not in vals:
+                company = order_companies.get(vals.get('order_id')) or self.env.company
+                vals_by_company[company].append(vals)
+        if not vals_by_company:
+            return
 
-                if product and product.standard_price:
-                    margin_multiplier = 1.0 + (margin_percent / 100.0)
-                    vals['price_unit'] = product.standard_price * margin_multiplier
+        orders = self.env['sale.order'].browse(list(order_companies))
+        order_data = {
+            order.id: (order.partner_id.id, order.pricelist_id.id, fields.Date.to_date(order.date_order))
+            for order in orders
+        }
+        today = fields.Date.context_today(self)
+        for company, company_vals in vals_by_company.items():
+            items = [
+                (vals['product_id'],) + order_data.get(vals.get('order_id'), (False, False, today))
+                for vals in company_vals
+            ]
+            margins = self.env['sale.margin.rule']._resolve_margin_percents(items, company)
+            for vals, margin_percent in zip(company_vals, margins):
+                vals['margin_percent'] = DEFAULT_MARGIN_PERCENT if margin_percent is None else margin_percent
 
-        return super(SaleOrderLine, self).create(vals_list)
+    def _get_rule_margin_percent(self):
+        """Margin of the margin rule matching this line, or None"""
+        self.ensure_one()
+        order = self.order_id
+        item = (
+            self.product_id.id,
+            order.partner_id.id,
+            order.pricelist_id.id,
+            fields.Date.to_date(order.date_order) or fields.Date.context_today(self),
+        )
+        return self.env['sale.margin.rule']._resolve_margin_percents(
+            [item], order.company_id or self.env.company,
+        )[0]
 
+    @instrumented('write')
     def write(self, vals):
         """
         Override write to recompute price_unit when margin or product changes
         if price_unit not explicitly provided in vals.
         Only applies in draft/sent states.
         Note: margin_percent is stored as number (20.0 for 20%, 100.0 for 100%)
+
+        Lines are grouped by their new price so that a mass edit issues one
+        write per distinct price instead of one write per line.
         """
+        self.env['sale.margin.analysis']._mark_lines_dirty(
+            self.ids, capture_old_groups='product_id' in vals or 'order_id' in vals,
+        )
+
+        if self._is_margin_compute_mode():
+            return self._write_margin_compute_mode(vals)
+
         # If price_unit is being explicitly set by user, don't auto-compute
         if 'price_unit' in vals:
+            return self._write_price_unit(vals)
+
+        if set(vals) == {'margin_percent'} and self._is_margin_concurrent_mode():
+            return self._write_margin_percent_concurrent(vals['margin_percent'])
+
+        # Check if margin, product or UoM is changing
+        if 'margin_percent' in vals or 'product_id' in vals or 'product_uom_id' in vals:
+            price_groups, other_lines = self._group_lines_by_margin_price(vals)
+
+            # Lines outside quotation states or already at the right price
+            if other_lines:
+                super(SaleOrderLine, other_lines).write(vals)
+
+            for price_unit, lines in price_groups.items():
+                super(SaleOrderLine, lines).write(dict(vals, price_unit=price_unit, margin_price_manual=False))
+
+            return True
+
+        return super(SaleOrderLine, self).write(vals)
+
+    def _write_margin_percent_concurrent(self, margin_percent):
+        """
+        Margin-only write for quotations edited by several users at once.
+
+        Row locks are taken in a deterministic order, so that concurrent
+        margin updates wait for each other instead of deadlocking: the lines
+        by id first, the rows of their orders last, just before their totals
+        are flushed, which keeps the shared order row locked only for the
+        end of the transaction.
+
+        The write is idempotent: lines already at this margin and price are
+        not written, so a request retried after a serialization failure (the
+        server restarts the whole transaction) or submitted twice only
+        updates the lines that still differ.
+        """
+        if not self:
+            return True
+        self.env.cr.execute(SQL(
+            "SELECT id FROM sale_order_line WHERE id IN %s ORDER BY id FOR NO KEY UPDATE",
+            tuple(self.ids),
+        ))
+        vals = {'margin_percent': margin_percent}
+        price_groups, other_lines = self._group_lines_by_margin_price(vals)
+        other_lines = other_lines.filtered(lambda line: line.margin_percent != margin_percent)
+        lines = other_lines.union(*price_groups.values())
+        if not lines:
+            return True
+
+        if other_lines:
+            super(SaleOrderLine, other_lines).write(vals)
+        for price_unit, group_lines in price_groups.items():
+            super(SaleOrderLine, group_lines).write(dict(vals, price_unit=price_unit, margin_price_manual=False))
+        lines.flush_recordset()
+
+        orders = lines.order_id
+        if orders:
+            self.env.cr.execute(SQL(
+                "SELECT id FROM sale_order WHERE id IN %s ORDER BY id FOR NO KEY UPDATE",
+                tuple(orders.ids),
+            ))
+            orders.flush_recordset()
+        return True
+
+    def unlink(self):
+        self.env['sale.margin.analysis']._mark_lines_dirty(self.ids, capture_old_groups=True)
+        return super(SaleOrderLine, self).unlink()
+
+    def _write_margin_compute_mode(self, vals):
+        """
+        write() in computed price mode: _compute_price_unit reprices the
+        lines, this keeps track of manual prices and marks the price of the
+        quotation lines to recompute on margin changes, as the margin is not
+        a dependency of the compute.
+        """
+        if 'price_unit' in vals:
+            return self._write_price_unit(vals)
+
+        if 'margin_percent' not in vals and 'product_id' not in vals:
             return super(SaleOrderLine, self).write(vals)
 
-        # Check if margin or product is changing
-        if 'margin_percent' in vals or 'product_id' in vals:
-            for line in self:
-                # Only auto-update in quotation states
-                if line.order_id and line.order_id.state not in ('draft', 'sent'):
-                    continue
+        # A margin or product change hands the price back to the margin
+        res = super(SaleOrderLine, self).write(dict(vals, margin_price_manual=False))
+        if 'margin_percent' in vals and 'product_id' not in vals:
+            quotation_lines = self.filtered(lambda line: not line.order_id or line.order_id.state in ('draft', 'sent'))
+            self.env.add_to_compute(self._fields['price_unit'], quotation_lines)
+        return res
 
-                # Determine the product and margin to use
-                product = line.product_id
-                if 'product_id' in vals:
-                    product = self.env['product.product'].browse(vals['product_id'])
+    def _get_margin_conversion_items(self, product=None, uom=None):
+        """
+        (product, company, currency, uom, date) of the lines of self, as
+        expected by the pricing service's _get_cost_conversion_factors.
 
-                margin_percent = vals.get('margin_percent', line.margin_percent)
+        :param product: product.product record to use instead of each
+            line's product (e.g. the product being written)
+        :param uom: uom.uom record to use instead of each line's UoM
+        """
+        items = []
+        for line in self:
+            line_product = line.product_id if product is None else product
+            if uom is not None:
+                line_uom = uom
+            else:
+                # A product change resets the line UoM to the product UoM
+                line_uom = line.product_uom_id if product is None else product.uom_id
+            order = line.order_id
+            items.append((line_product, order.company_id or self.env.company, order.currency_id, line_uom, order.date_order))
+        return items
 
-                # Compute new price (divide by 100 to convert percentage to decimal)
-                cost = product.standard_price if product else 0.0
-                margin_multiplier = 1.0 + (margin_percent / 100.0)
-                computed_price = cost * margin_multiplier
+    def _get_margin_costs(self, product=None, uom=None):
+        """
+        Unit costs the margin applies to, aligned with the lines of self:
+        product costs read in bulk through the pricing service (per order
+        company), converted to the order currency and the line UoM with the
+        transaction-scoped rate and UoM factor tables.
 
-                # Update price_unit in vals for this specific line
-                line_vals = vals.copy()
-                line_vals['price_unit'] = computed_price
-                super(SaleOrderLine, line).write(line_vals)
+        :param product: product.product record to use instead of each
+            line's product (e.g. the product being written)
+        :param uom: uom.uom record to use instead of each line's UoM
+        """
+        pricing = self.env['sale.line.margin.pricing']
+        items = self._get_margin_conversion_items(product=product, uom=uom)
 
-            # If we updated prices individually, return True
-            if any(line.order_id and line.order_id.state in ('draft', 'sent') for line in self):
-                return True
+        product_ids_by_company = defaultdict(set)
+        for line_product, company, *_conversion in items:
+            product_ids_by_company[company].update(line_product.ids)
+        costs = {
+            company: pricing._get_costs(self.env['product.product'].browse(list(product_ids)), company)
+            for company, product_ids in product_ids_by_company.items()
+        }
+        factors = pricing._get_cost_conversion_factors(items)
+        return [
+            costs[company][line_product.id] * factor if line_product else 0.0
+            for (line_product, company, *_conversion), factor in zip(items, factors)
+        ]
 
-        return super(SaleOrderLine, self).write(vals)
+    def _get_margin_prices(self, margins=None, product=None, uom=None):
+        """
+        Margin-based prices of the lines of self, combined with the price of
+        their order pricelist according to the pricelist mode (see the
+        pricing service's _compute_line_prices).
 
-    def _should_auto_compute_price(self, vals):
+        :param margins: margins to price with, aligned with self, instead
+            of the margins of the lines
+        :param product: see _get_margin_costs
+        :param uom: see _get_margin_costs
+        :return: tuple (costs, prices) of lists aligned with self
+        """
+        pricing = self.env['sale.line.margin.pricing']
+        costs = self._get_margin_costs(product=product, uom=uom)
+        pricelist_items = None
+        if pricing._get_pricelist_mode() != 'margin':
+            pricelist_items = [
+                (line.order_id.pricelist_id, line_product, company, currency, line_uom, line.product_uom_qty, date)
+                for line, (line_product, company, currency, line_uom, date)
+                in zip(self, self._get_margin_conversion_items(product=product, uom=uom))
+            ]
+        prices = pricing._compute_line_prices(
+            costs,
+            self.mapped('margin_percent') if margins is None else margins,
+            self._get_price_unit_rounding(),
+            pricelist_items,
+        )
+        return costs, prices
+
+    def _group_lines_by_margin_price(self, vals):
+        """
+        Split self into groups of lines that get the same margin-based
+        price_unit once vals is written.
+
+        :return: tuple ({price_unit: lines}, other_lines) where other_lines
+            are the lines whose price must not be touched: lines of
+            confirmed/cancelled orders, and lines whose price would not
+            change (only when the product and UoM stay the same, as changing
+            them triggers the standard price recomputation)
+        """
+        price_digits = self.env['decimal.precision'].precision_get('Product Price')
+        new_product = 'product_id' in vals and self.env['product.product'].browse(vals['product_id'])
+        new_uom = 'product_uom_id' in vals and self.env['uom.uom'].browse(vals['product_uom_id'])
+
+        # Only auto-update in quotation states
+        quotation_lines = self.filtered(
+            lambda line: not line.order_id or line.order_id.state in ('draft', 'sent')
+        )
+        other_ids = (self - quotation_lines).ids
+
+        _costs, prices = quotation_lines._get_margin_prices(
+            margins=[vals.get('margin_percent', line.margin_percent) for line in quotation_lines],
+            product=None if new_product is False else new_product,
+            uom=None if new_uom is False else new_uom,
+        )
+
+        price_groups = defaultdict(list)
+        for line, computed_price in zip(quotation_lines, prices):
+            if new_product is False and new_uom is False and not float_compare(
+                computed_price, line.price_unit, precision_digits=price_digits
+            ):
+                other_ids.append(line.id)
+                continue
+
+            price_groups[computed_price].append(line.id)
+
+        return (
+            {price: self.browse(ids) for price, ids in price_groups.items()},
+            self.browse(other_ids),
+        )
+
+    @api.model
+    def _get_price_unit_rounding(self):
+        """Rounding precision of price_unit ('Product Price' decimal accuracy)"""
+        return 10 ** -self.env['decimal.precision'].precision_get('Product Price')
+
+    def _apply_margin_price(self):
+        """
+        Re-apply the margin formula to price_unit of the quotation lines in
+        self, from their current product cost and margin_percent.
+
+        :return: number of lines whose price was updated
+        """
+        price_groups, _other_lines = self._group_lines_by_margin_price({})
+        for price_unit, lines in price_groups.items():
+            lines.with_context(margin_price_auto=True).write({'price_unit': price_unit})
+        return sum(len(lines) for lines in price_groups.values())
+
+    def _write_margin_prices(self, margins, unit_costs):
+        """
+        Write margin_percent and the matching margin price_unit on the lines
+        of self in a single UPDATE, e.g. for margins solved for a whole order.
+        The prices are no longer manual. The current user must be allowed
+        to write the lines, as the UPDATE bypasses the ORM. The prices are
+        plain margin prices: only for the 'margin' pricelist mode.
+
+        :param margins: new margins, aligned with self
+        :param unit_costs: costs the margins apply to, aligned with self
+        """
+        self.check_access('write')
+        prices = self.env['sale.line.margin.pricing']._compute_margin_prices(
+            unit_costs, margins, self._get_price_unit_rounding(),
+        )
+        fnames = ['margin_percent', 'price_unit', 'margin_price_manual']
+        self.flush_recordset(fnames)
+        self.env.cr.execute(SQL(
+            """
+            UPDATE sale_order_line line
+               SET margin_percent = solved.margin,
+                   price_unit = solved.price,
+                   margin_price_manual = FALSE,
+                   write_uid = %s,
+                   write_date = NOW() AT TIME ZONE 'UTC'
+              FROM unnest(%s::int[], %s::float8[], %s::float8[]) AS solved(line_id, margin, price)
+             WHERE line.id = solved.line_id
+            """,
+            self.env.uid, self.ids, list(margins), prices,
+        ))
+        self.env['sale.margin.analysis']._mark_lines_dirty(self.ids)
+        self.invalidate_recordset(fnames + ['write_uid', 'write_date'])
+        self.modified(fnames)
+
+    def _snapshot_confirmed_costs(self):
+        """
+        Freeze the cost of the lines of self, as of the confirmation of their
+        order, in a single UPDATE. Their margin does not change: the
+        snapshot is the cost their margin_amount was computed from.
+        """
+        if not self:
+            return
+        self.flush_recordset(['cost_price'])
+        self.env.cr.execute(SQL(
+            "UPDATE sale_order_line SET confirmed_cost_price = cost_price, cost_confirmed = TRUE WHERE id IN %s",
+            tuple(self.ids),
+        ))
+        self.invalidate_recordset(['confirmed_cost_price', 'cost_confirmed'])
+
+    def _clear_confirmed_costs(self):
+        """Drop the confirmation cost of the lines of self, their margin follows cost_price again"""
+        if not self:
+            return
+        self.env.cr.execute(SQL(
+            "UPDATE sale_order_line SET confirmed_cost_price = NULL, cost_confirmed = FALSE WHERE id IN %s AND cost_confirmed",
+            tuple(self.ids),
+        ))
+        self.invalidate_recordset(['confirmed_cost_price', 'cost_confirmed'])
+        self.modified(['confirmed_cost_price', 'cost_confirmed'])
+
+    @api.model
+    def _propagate_cost_price(self, products):
+        """
+        Refresh cost_price and the margin-based price_unit of the draft/sent
+        lines of products, after their standard_price changed for the
+        current company.
+
+        Lines are found through the product_id index and updated with
+        set-based SQL in chunks of COST_PROPAGATION_CHUNK_SIZE, with the cost
+        converted to the order currency and line UoM; only one chunk
+        of records is ever marked for recomputation (subtotals, order totals)
+        and held in the cache at a time.
+
+        Prices entered by hand are left alone, and so are the prices of
+        zero-cost products, which keep their standard price like on create.
+        This is a side effect of the cost change, like a stored recompute:
+        it runs as superuser, whoever may edit the product cost.
+        """
+        if not products:
+            return
+        self = self.sudo()
+        company = self.env.company
+        price_digits = self.env['decimal.precision'].precision_get('Product Price')
+        costs = self.env['sale.line.margin.pricing']._get_costs(products, company)
+
+        self.flush_model(['product_id', 'order_id', 'margin_percent', 'price_unit', 'margin_price_manual', 'product_uom_id'])
+        self.env['sale.order'].flush_model(['state', 'company_id', 'currency_id', 'date_order'])
+        self.env.cr.execute(SQL(
+            """
+            SELECT line.id, line.product_id, line.product_uom_id, so.currency_id, so.date_order,
+                   line.margin_price_manual IS TRUE
+              FROM sale_order_line line
+              JOIN sale_order so ON so.id = line.order_id
+             WHERE line.product_id IN %s
+               AND so.state IN ('draft', 'sent')
+               AND so.company_id = %s
+          ORDER BY line.id
+            """,
+            tuple(costs), company.id,
+        ))
+        rows = self.env.cr.fetchall()
+
+        # The margin applies to the cost in the order currency and the line UoM
+        pricing = self.env['sale.line.margin.pricing']
+        products_by_id = {product.id: product for product in products}
+        Currency = self.env['res.currency']
+        Uom = self.env['uom.uom']
+        factors = pricing._get_cost_conversion_factors([
+            (products_by_id[product_id], company, Currency.browse(currency_id), Uom.browse(uom_id), date_order)
+            for _line_id, product_id, uom_id, currency_id, date_order, _manual in rows
+        ])
+
+        # Combined with pricelist prices, the new prices are computed in batch by the pricing service
+        with_pricelist = pricing._get_pricelist_mode() != 'margin'
+        price_unit_sql = SQL(
+            """
+            price_unit = CASE WHEN cost.value = 0.0 OR line.margin_price_manual THEN line.price_unit
+                              ELSE ROUND((cost.value * cost.factor * (1.0 + COALESCE(line.margin_percent, 0.0) / 100.0))::numeric, %s)
+                         END
+            """,
+            price_digits,
+        )
+
+        for chunk in split_every(COST_PROPAGATION_CHUNK_SIZE, list(zip(rows, factors)), list):
+            chunk_ids = [row[0] for row, _factor in chunk]
+            self.env.cr.execute(SQL(
+                """
+                UPDATE sale_order_line line
+                   SET cost_price = cost.value
+                       %s
+                  FROM unnest(%s::int[], %s::float8[], %s::float8[]) AS cost(line_id, value, factor)
+                 WHERE line.id = cost.line_id
+                """,
+                SQL() if with_pricelist else SQL(", %s", price_unit_sql),
+                chunk_ids,
+                [costs[row[1]] for row, _factor in chunk],
+                [factor for _row, factor in chunk],
+            ))
+            self.env['sale.margin.analysis']._mark_lines_dirty(chunk_ids)
+            lines = self.browse(chunk_ids)
+            if with_pricelist:
+                lines.invalidate_recordset(['cost_price'])
+                priced_lines = self.browse([row[0] for row, _factor in chunk if costs[row[1]] and not row[5]])
+                _line_costs, prices = priced_lines._get_margin_prices()
+                self.env.cr.execute(SQL(
+                    """
+                    UPDATE sale_order_line line
+                       SET price_unit = priced.price
+                      FROM unnest(%s::int[], %s::float8[]) AS priced(line_id, price)
+                     WHERE line.id = priced.line_id
+                    """,
+                    priced_lines.ids, prices,
+                ))
+            lines.invalidate_recordset(['cost_price', 'price_unit'])
+            lines.modified(['cost_price', 'price_unit'])
+            # Recompute the dependent amounts of this chunk and drop it from the cache
+            self.env.flush_all()
+            self.env.invalidate_all()
+
+    @api.model
+    def _iter_margin_export_rows(self, domain, batch_size=MARGIN_EXPORT_BATCH_SIZE):
+        """
+        Yield the margin export rows (see MARGIN_EXPORT_COLUMNS) of the lines
+        matching domain, record rules included, in lists of batch_size rows.
+
+        Rows are fetched from a server-side cursor declared in the current
+        transaction, so only one batch is held in memory whatever the number
+        of lines; self.env.cr must stay open until the iteration ends.
+        """
+        self.check_access('read')
+        self.env.flush_all()
+        query = self._search(domain)
+        self.env.cr.execute(SQL(
+            """
+            DECLARE sale_margin_export NO SCROLL CURSOR FOR
+            SELECT sale_order.name,
+                   sale_order.date_order,
+                   sale_order.state,
+                   salesperson.name,
+                   COALESCE(template.name->>%(lang)s, template.name->>'en_US'),
+                   line.product_uom_qty,
+                   line.cost_price,
+                   line.margin_percent,
+                   line.price_unit,
+                   line.price_subtotal,
+                   line.margin_amount,
+                   currency.name
+              FROM sale_order_line line
+              JOIN sale_order ON sale_order.id = line.order_id
+              LEFT JOIN res_users ON res_users.id = sale_order.user_id
+              LEFT JOIN res_partner salesperson ON salesperson.id = res_users.partner_id
+              LEFT JOIN product_product product ON product.id = line.product_id
+              LEFT JOIN product_template template ON template.id = product.product_tmpl_id
+              LEFT JOIN res_currency currency ON currency.id = line.currency_id
+             WHERE line.id IN %(line_ids)s
+             ORDER BY line.id
+            """,
+            lang=self.env.lang or 'en_US',
+            line_ids=query.subselect(),
+        ))
+        while True:
+            self.env.cr.execute(SQL("FETCH FORWARD %s FROM sale_margin_export", batch_size))
+            rows = self.env.cr.fetchall()
+            if not rows:
+                break
+            yield rows
+        self.env.cr.execute(SQL("CLOSE sale_margin_export"))
+
+    @instrumented('should_auto_compute_price', count_records=lambda self, vals, order_states=None: 1)
+    def _should_auto_compute_price(self, vals, order_states=None):
         """
         Helper to determine if we should auto-compute price_unit.
         Returns True if:
         - price_unit is not explicitly provided in vals
         - product_id is provided
         - order state is draft or sent (check via order_id if provided)
+
+        :param dict order_states: optional {order_id: state} map, used instead
+            of browsing the order when it already holds vals['order_id']
         """
         if 'price_unit' in vals:
             return False
@@ -147,8 +937,11 @@ class SaleOrderLine(models.Model):
 
         # Check order state if order_id provided
         if vals.get('order_id'):
-            order = self.env['sale.order'].browse(vals['order_id'])
-            if order.state not in ('draft', 'sent'):
+            if order_states is not None and vals['order_id'] in order_states:
+                state = order_states[vals['order_id']]
+            else:
+                state = self.env['sale.order'].browse(vals['order_id']).state
+            if state not in ('draft', 'sent'):
                 return False
 
         return True
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+from odoo import api, models, fields
+
+
+class SaleOrderTemplateLine(models.Model):
+    _inherit = 'sale.order.template.line'
+
+    use_margin_rule = fields.Boolean(
+        string='Use Margin Rule',
+        default=True,
+        help='Give the quotation lines created from this template line the margin of the '
+             'matching margin rule. Setting a margin on the template line clears it'
+    )
+    margin_percent = fields.Float(
+        string='Margin %',
+        help='Margin of the quotation lines created from this template line, 0 to sell at cost'
+    )
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        for vals in vals_list:
+            if 'margin_percent' in vals:
+                vals.setdefault('use_margin_rule', False)
+        return super(SaleOrderTemplateLine, self).create(vals_list)
+
+    def write(self, vals):
+        if 'margin_percent' in vals:
+            vals = dict({'use_margin_rule': False}, **vals)
+        return super(SaleOrderTemplateLine, self).write(vals)
+
+    def _prepare_order_line_values(self):
+        vals = super(SaleOrderTemplateLine, self)._prepare_order_line_values()
+        # Lines using the margin rule get its margin on create
+        if not self.display_type and not self.use_margin_rule:
+            vals['margin_percent'] = self.margin_percent
+        return vals
@@ -1,3 +1,4 @@
 # -*- coding: utf-8 -*-
 
 from . import test_sale_line_margin_price
+from . import test_sale_line_margin_price_benchmark
@@ -1,7 +1,15 @@
 # -*- coding: utf-8 -*-
 
-from odoo.tests.common import TransactionCase
+import io
+from unittest.mock import patch
+
+from odoo.exceptions import AccessError, UserError
+from odoo.tests.common import TransactionCase, new_test_user
 from odoo.tests import tagged
+from odoo.tools import SQL, float_compare, float_round
+
+from ..hooks import _fill_cost_price, _fill_margin_amount
+from ..tools import margin_metrics
 
 
 @tagged('post_install', '-at_install')
@@ -469,3 +477,1181 @@ class TestSaleLineMarginPrice(TransactionCase):
             places=2,
             msg="Price should not update in cancelled orders"
         )
+
+    def test_16_batched_create_query_count_is_flat(self):
+        """
+        Test that pricing a create() vals_list reads products and orders in
+        a constant number of queries, whatever the number of lines.
+        """
+        products = self.env['product.product'].create([{
+            'name': f'Test Batch Product {i}',
+            'type': 'consu',
+            'standard_price': 10.0 * (i + 1),
+        } for i in range(50)])
+        order_sent = self.env['sale.order'].create({
+            'partner_id': self.partner.id,
+            'state': 'sent',
+        })
+        orders = self.sale_order + order_sent
+
+        def count_pricing_queries(size):
+            vals_list = [{
+                'order_id': orders[i % 2].id,
+                'product_id': products[i].id,
+                'product_uom_qty': 1.0,
+                'margin_percent': 50.0,
+            } for i in range(size)]
+            self.env.flush_all()
+            self.env.invalidate_all()
+            queries_before = self.env.cr.sql_log_count
+            self.env['sale.order.line']._prepare_margin_price_vals(vals_list)
+            return self.env.cr.sql_log_count - queries_before, vals_list
+
+        small_count, _small_vals = count_pricing_queries(5)
+        large_count, large_vals = count_pricing_queries(50)
+
+        self.assertEqual(
+            small_count,
+            large_count,
+            msg="Pricing 50 lines should not issue more queries than pricing 5"
+        )
+
+        # Every line is priced from the batched reads: cost * 1.5
+        for i, vals in enumerate(large_vals):
+            self.assertAlmostEqual(vals['price_unit'], 10.0 * (i + 1) * 1.5, places=2)
+
+        # And the batched path is the one used by create()
+        lines = self.env['sale.order.line'].create(large_vals[:10])
+        self.assertAlmostEqual(lines[3].price_unit, 60.0, places=2)
+
+    def test_17_mass_margin_write_groups_by_price(self):
+        """
+        Test that a margin write on many lines is split into one group per
+        distinct resulting price, and skips lines already at that price.
+        """
+        product_chair = self.env['product.product'].create({
+            'name': 'Test Chair',
+            'type': 'consu',
+            'standard_price': 50.0,
+        })
+        lines = self.env['sale.order.line'].create([{
+            'order_id': self.sale_order.id,
+            'product_id': (self.product_desk if i % 2 else product_chair).id,
+            'product_uom_qty': 1.0,
+            'margin_percent': 20.0,
+        } for i in range(10)])
+
+        price_groups, other_lines = lines._group_lines_by_margin_price({'margin_percent': 30.0})
+        self.assertEqual(sorted(price_groups), [65.0, 130.0])
+        self.assertEqual(len(price_groups[65.0]), 5)
+        self.assertFalse(other_lines)
+
+        # Lines already priced at the target margin are left out of the groups
+        price_groups, other_lines = lines._group_lines_by_margin_price({'margin_percent': 20.0})
+        self.assertFalse(price_groups)
+        self.assertEqual(other_lines, lines)
+
+        lines.write({'margin_percent': 30.0})
+        for line in lines:
+            expected = 130.0 if line.product_id == self.product_desk else 65.0
+            self.assertAlmostEqual(line.price_unit, expected, places=2)
+            self.assertAlmostEqual(line.margin_percent, 30.0, places=2)
+
+    def test_18_mass_margin_write_mixed_states(self):
+        """
+        Test that a margin write on lines of both a quotation and a confirmed
+        order updates the margin everywhere but the price only on the quotation.
+        """
+        order_confirmed = self.env['sale.order'].create({
+            'partner_id': self.partner.id,
+        })
+        line_confirmed = self.env['sale.order.line'].create({
+            'order_id': order_confirmed.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': 1.0,
+        })
+        order_confirmed.action_confirm()
+        line_draft = self.env['sale.order.line'].create({
+            'order_id': self.sale_order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': 1.0,
+        })
+
+        (line_draft + line_confirmed).write({'margin_percent': 50.0})
+
+        self.assertAlmostEqual(line_draft.price_unit, 150.0, places=2)
+        self.assertAlmostEqual(line_confirmed.price_unit, 120.0, places=2)
+        self.assertAlmostEqual(line_confirmed.margin_percent, 50.0, places=2)
+
+    def test_19_cost_change_propagates_to_quotations(self):
+        """
+        Test that writing standard_price refreshes cost_price and price_unit
+        of open quotation lines, and leaves confirmed orders untouched.
+        """
+        order_confirmed = self.env['sale.order'].create({
+            'partner_id': self.partner.id,
+        })
+        line_confirmed = self.env['sale.order.line'].create({
+            'order_id': order_confirmed.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': 1.0,
+        })
+        order_confirmed.action_confirm()
+        line_draft = self.env['sale.order.line'].create({
+            'order_id': self.sale_order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': 2.0,
+            'margin_percent': 50.0,
+        })
+
+        self.product_desk.standard_price = 200.0
+
+        self.assertAlmostEqual(line_draft.cost_price, 200.0, places=2)
+        self.assertAlmostEqual(line_draft.price_unit, 300.0, places=2)
+        self.assertAlmostEqual(line_draft.price_subtotal, 600.0, places=2)
+        self.assertAlmostEqual(self.sale_order.amount_untaxed, 600.0, places=2)
+
+        self.assertAlmostEqual(line_confirmed.cost_price, 100.0, places=2)
+        self.assertAlmostEqual(line_confirmed.price_unit, 120.0, places=2)
+
+    def test_40_cost_change_keeps_manual_and_zero_cost_prices(self):
+        """
+        Test that a cost change leaves prices entered by hand alone, that a
+        product whose cost drops to zero keeps its price, as zero-cost
+        products keep their standard price on create, and that users who
+        cannot write the quotations still propagate cost changes.
+        """
+        product = self.env['product.product'].create({
+            'name': 'Test Chair',
+            'type': 'consu',
+            'standard_price': 50.0,
+            'list_price': 70.0,
+        })
+        line_margin, line_manual = self.env['sale.order.line'].create([{
+            'order_id': self.sale_order.id,
+            'product_id': product.id,
+            'product_uom_qty': 1.0,
+        }, {
+            'order_id': self.sale_order.id,
+            'product_id': product.id,
+            'product_uom_qty': 1.0,
+        }])
+        line_manual.write({'price_unit': 75.0})
+        self.assertFalse(line_margin.margin_price_manual)
+        self.assertTrue(line_manual.margin_price_manual)
+
+        product.standard_price = 60.0
+        self.assertAlmostEqual(line_margin.price_unit, 72.0, places=2)
+        self.assertAlmostEqual(line_manual.price_unit, 75.0, places=2)
+        self.assertAlmostEqual(line_manual.cost_price, 60.0, places=2)
+
+        # A margin change hands the price back to the margin
+        line_manual.write({'margin_percent': 50.0})
+        self.assertFalse(line_manual.margin_price_manual)
+        self.assertAlmostEqual(line_manual.price_unit, 90.0, places=2)
+
+        product.standard_price = 0.0
+        self.assertEqual(line_margin.cost_price, 0.0)
+        self.assertAlmostEqual(line_margin.price_unit, 72.0, places=2)
+        self.assertAlmostEqual(line_manual.price_unit, 90.0, places=2)
+
+        # Propagating a cost change does not need write access to the quotations
+        salesman = new_test_user(self.env, login='margin_cost_salesman', groups='sales_team.group_sale_salesman')
+        self.sale_order.user_id = self.env.ref('base.user_admin')
+        Line = self.env.registry['sale.order.line']
+        with patch.object(Line, '_propagate_cost_price'):
+            product.standard_price = 40.0
+        self.env['sale.order.line'].with_user(salesman)._propagate_cost_price(product)
+        self.assertAlmostEqual(line_margin.price_unit, 48.0, places=2)
+        self.assertAlmostEqual(line_manual.price_unit, 60.0, places=2)
+
+    def test_20_cost_cache(self):
+        """
+        Test that the pricing service serves repeated cost lookups from the
+        record cache, and that neither a standard_price write nor its
+        rollback to a savepoint leaves a stale cost behind.
+        """
+        pricing = self.env['sale.line.margin.pricing']
+        self.env.invalidate_all()
+        self.assertEqual(pricing._get_costs(self.product_desk), {self.product_desk.id: 100.0})
+
+        queries_before = self.env.cr.sql_log_count
+        self.assertAlmostEqual(pricing._get_margin_price(self.product_desk, 50.0), 150.0, places=2)
+        self.assertEqual(
+            self.env.cr.sql_log_count,
+            queries_before,
+            msg="Cached cost should not be read again from the database"
+        )
+
+        self.product_desk.standard_price = 80.0
+        self.assertEqual(pricing._get_costs(self.product_desk), {self.product_desk.id: 80.0})
+
+        with self.assertRaises(UserError), self.env.cr.savepoint():
+            self.product_desk.standard_price = 60.0
+            self.assertEqual(pricing._get_costs(self.product_desk), {self.product_desk.id: 60.0})
+            raise UserError("rollback")
+        self.assertEqual(pricing._get_costs(self.product_desk), {self.product_desk.id: 80.0})
+
+    def test_21_reprice_open_quotations(self):
+        """
+        Test that the re-pricing engine re-applies margins on open
+        quotations only, leaves prices entered by hand alone, and reports
+        its throughput.
+        """
+        line_draft = self.env['sale.order.line'].create({
+            'order_id': self.sale_order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': 1.0,
+            'margin_percent': 30.0,
+        })
+        order_confirmed = self.env['sale.order'].create({
+            'partner_id': self.partner.id,
+        })
+        line_confirmed = self.env['sale.order.line'].create({
+            'order_id': order_confirmed.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': 1.0,
+        })
+        line_manual = self.env['sale.order.line'].create({
+            'order_id': self.sale_order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': 1.0,
+        })
+        order_confirmed.action_confirm()
+
+        # Margin prices now out of line with the margins, e.g. after SQL updates
+        (line_draft + line_confirmed).write({'price_unit': 99.0, 'margin_price_manual': False})
+        line_manual.write({'price_unit': 99.0})
+
+        report = self.env['sale.line.margin.repricing'].reprice_open_quotations(
+            order_ids=(self.sale_order + order_confirmed).ids, workers=4, chunk_size=1,
+        )
+
+        self.assertEqual(report['orders'], 1)
+        self.assertEqual(report['lines'], 1)
+        self.assertIn('lines_per_second', report)
+        self.assertAlmostEqual(line_draft.price_unit, 130.0, places=2)
+        self.assertAlmostEqual(line_confirmed.price_unit, 99.0, places=2)
+        self.assertAlmostEqual(line_manual.price_unit, 99.0, places=2)
+
+    def test_22_vectorized_kernel_matches_scalar_path(self):
+        """
+        Test that the batch pricing kernel returns the same prices as the
+        scalar formula rounded with float_round, for various roundings.
+        """
+        pricing = self.env['sale.line.margin.pricing']
+        costs = [100.0, 0.0, 12.345, 0.005, 99.995, 1e6 / 3, 7.0, 1.125]
+        margins = [20.0, 50.0, 33.3, 0.0, -10.0, 12.5, -100.0, 100.0]
+        for rounding in (0.01, 0.001, 1.0, 0.05):
+            prices = pricing._compute_margin_prices(costs, margins, rounding)
+            for cost, margin, price in zip(costs, margins, prices):
+                expected = float_round(
+                    pricing._compute_margin_price(cost, margin), precision_rounding=rounding,
+                )
+                self.assertEqual(
+                    float_compare(price, expected, precision_rounding=rounding),
+                    0,
+                    msg=f"cost={cost} margin={margin} rounding={rounding}: {price} != {expected}",
+                )
+
+        # Per-item rounding precisions (e.g. lines in different currencies)
+        prices = pricing._compute_margin_prices([10.0, 10.0], [33.3333, 33.3333], [0.01, 1.0])
+        self.assertAlmostEqual(prices[0], 13.33, places=2)
+        self.assertAlmostEqual(prices[1], 13.0, places=2)
+
+    def test_23_streaming_import(self):
+        """
+        Test that lines imported from a CSV file in batches are priced from
+        their margin_percent column.
+        """
+        self.product_desk.default_code = 'TEST-DESK'
+        self.product_zero_cost.default_code = 'TEST-ZERO'
+        content = (
+            "default_code,product_uom_qty,margin_percent,name\n"
+            "TEST-DESK,1,20,\n"
+            "TEST-DESK,2,50,Big desk\n"
+            "TEST-ZERO,1,50,\n"
+            "TEST-DESK,3,100,\n"
+            "TEST-DESK,1,-10,\n"
+        )
+        progress = []
+        imported = self.env['sale.margin.line.import'].import_margin_lines(
+            self.sale_order, io.BytesIO(content.encode()), 'csv',
+            batch_size=2, progress_callback=progress.append,
+        )
+
+        self.assertEqual(imported, 5)
+        self.assertEqual(progress, [2, 4, 5])
+        lines = self.sale_order.order_line.sorted('id')
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(
+            [round(price, 2) for price in lines.mapped('price_unit')],
+            [120.0, 150.0, 0.0, 200.0, 90.0],
+        )
+        self.assertEqual(lines[1].name, 'Big desk')
+
+        with self.assertRaises(UserError):
+            self.env['sale.margin.line.import'].import_margin_lines(
+                self.sale_order, io.BytesIO(b"default_code,product_uom_qty,margin_percent\nNOPE,1,20\n"), 'csv',
+            )
+
+        # A blank margin leaves the default margin, a non-numeric one is refused
+        order = self.env['sale.order'].create({'partner_id': self.partner.id})
+        self.env['sale.margin.line.import'].import_margin_lines(
+            order, io.BytesIO(b"default_code,product_uom_qty,margin_percent\nTEST-DESK,1,\nTEST-DESK,, \n"), 'csv',
+        )
+        self.assertEqual(order.order_line.mapped('margin_percent'), [20.0, 20.0])
+        self.assertEqual(order.order_line.mapped('price_unit'), [120.0, 120.0])
+        with self.assertRaisesRegex(UserError, 'margin_percent must be a number'):
+            self.env['sale.margin.line.import'].import_margin_lines(
+                order, io.BytesIO(b"default_code,product_uom_qty,margin_percent\nTEST-DESK,1,20%\n"), 'csv',
+            )
+
+    def test_24_metrics_instrumentation(self):
+        """
+        Test that the pricing entry points are only instrumented when the
+        metrics system parameter is set, that the parameter is not read again
+        on every call, and that metrics render in the Prometheus text format.
+        """
+        vals = {
+            'order_id': self.sale_order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': 1.0,
+        }
+        calls_before = margin_metrics.snapshot().get('create', {}).get('calls', 0)
+        self.env['sale.order.line'].create([vals])
+        self.assertEqual(margin_metrics.snapshot().get('create', {}).get('calls', 0), calls_before)
+
+        self.env['ir.config_parameter'].sudo().set_param('sale_line_margin_price.metrics_enabled', 'True')
+        self.env['sale.order.line'].create([vals, vals])
+        with self.assertQueryCount(0):
+            self.assertTrue(self.env['sale.line.margin.pricing']._is_metrics_enabled())
+
+        stats = margin_metrics.snapshot()['create']
+        self.assertEqual(stats['calls'], calls_before + 1)
+        self.assertGreaterEqual(stats['records'], 2)
+        self.assertGreater(stats['queries'], 0)
+        rendered = margin_metrics.render_prometheus()
+        self.assertIn('sale_margin_calls_total{entry_point="create"}', rendered)
+        self.assertIn('sale_margin_latency_seconds_bucket{entry_point="create",le="+Inf"}', rendered)
+
+    def test_25_margin_rules(self):
+        """
+        Test that new lines without an explicit margin get the margin of the
+        most specific matching rule, with category inheritance, and the 20%
+        default when no rule matches.
+        """
+        categ_parent = self.env['product.category'].create({'name': 'Test Furniture'})
+        categ_child = self.env['product.category'].create({
+            'name': 'Test Chairs',
+            'parent_id': categ_parent.id,
+        })
+        product_chair = self.env['product.product'].create({
+            'name': 'Test Chair',
+            'type': 'consu',
+            'categ_id': categ_child.id,
+            'standard_price': 50.0,
+        })
+        product_stool = self.env['product.product'].create({
+            'name': 'Test Stool',
+            'type': 'consu',
+            'categ_id': categ_child.id,
+            'standard_price': 10.0,
+        })
+        other_partner = self.env['res.partner'].create({'name': 'Other Customer'})
+        self.env['sale.margin.rule'].create([
+            {'name': 'Furniture', 'categ_id': categ_parent.id, 'margin_percent': 40.0},
+            {'name': 'Stool', 'product_id': product_stool.id, 'margin_percent': 60.0},
+            {'name': 'Stool for customer', 'product_id': product_stool.id,
+             'partner_id': self.partner.id, 'margin_percent': 70.0},
+            {'name': 'Expired', 'categ_id': categ_child.id, 'margin_percent': 5.0,
+             'date_end': '2000-01-01'},
+        ])
+        other_order = self.env['sale.order'].create({'partner_id': other_partner.id})
+
+        lines = self.env['sale.order.line'].create([
+            {'order_id': self.sale_order.id, 'product_id': product_chair.id},
+            {'order_id': self.sale_order.id, 'product_id': product_stool.id},
+            {'order_id': other_order.id, 'product_id': product_stool.id},
+            {'order_id': self.sale_order.id, 'product_id': self.product_desk.id},
+            {'order_id': self.sale_order.id, 'product_id': product_chair.id, 'margin_percent': 10.0},
+        ])
+
+        self.assertEqual(lines.mapped('margin_percent'), [40.0, 70.0, 60.0, 20.0, 10.0])
+        self.assertAlmostEqual(lines[0].price_unit, 70.0, places=2)
+        self.assertAlmostEqual(lines[1].price_unit, 17.0, places=2)
+
+        # Rule changes are picked up by the next resolution
+        self.env['sale.margin.rule'].search([('name', '=', 'Furniture')]).margin_percent = 45.0
+        line = self.env['sale.order.line'].create({
+            'order_id': self.sale_order.id,
+            'product_id': product_chair.id,
+        })
+        self.assertAlmostEqual(line.margin_percent, 45.0, places=2)
+
+    def test_26_computed_price_mode(self):
+        """
+        Test the computed price mode: price_unit follows the margin through
+        _compute_price_unit, manual prices are kept until the margin changes,
+        and confirmed orders are never repriced. The margin is not a
+        dependency of the standard compute.
+        """
+        price_unit_field = self.env['sale.order.line']._fields['price_unit']
+        self.assertNotIn('margin_percent', self.registry.field_depends[price_unit_field])
+        self.env['ir.config_parameter'].sudo().set_param('sale_line_margin_price.price_mode', 'compute')
+
+        line = self.env['sale.order.line'].create({
+            'order_id': self.sale_order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': 1.0,
+            'margin_percent': 50.0,
+        })
+        self.assertAlmostEqual(line.price_unit, 150.0, places=2)
+
+        line.write({'margin_percent': 30.0})
+        self.assertAlmostEqual(line.price_unit, 130.0, places=2)
+
+        # A manual price survives quantity changes...
+        line.write({'price_unit': 99.0})
+        self.assertTrue(line.margin_price_manual)
+        line.write({'product_uom_qty': 3.0})
+        self.assertAlmostEqual(line.price_unit, 99.0, places=2)
+
+        # ... until the margin is changed again
+        line.write({'margin_percent': 40.0})
+        self.assertFalse(line.margin_price_manual)
+        self.assertAlmostEqual(line.price_unit, 140.0, places=2)
+
+        self.sale_order.action_confirm()
+        self.assertAlmostEqual(line.price_unit, 140.0, places=2)
+        line.write({'margin_percent': 10.0})
+        self.assertAlmostEqual(line.price_unit, 140.0, places=2)
+
+    def test_27_margin_analysis_incremental(self):
+        """
+        Test that the margin analysis groups of changed lines are refreshed
+        at the end of the transaction, including the group a line leaves.
+        """
+        Analysis = self.env['sale.margin.analysis']
+        product_chair = self.env['product.product'].create({
+            'name': 'Test Chair',
+            'type': 'consu',
+            'standard_price': 50.0,
+        })
+        line = self.env['sale.order.line'].create({
+            'order_id': self.sale_order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': 2.0,
+            'margin_percent': 50.0,
+        })
+        # Runs the precommit hooks, as a commit would
+        self.env.cr.flush()
+
+        row = Analysis.search([('product_id', '=', self.product_desk.id)])
+        self.assertEqual(len(row), 1)
+        self.assertEqual(row.user_id, self.sale_order.user_id)
+        self.assertEqual(row.line_count, 1)
+        self.assertAlmostEqual(row.cost_total, 200.0, places=2)
+        self.assertAlmostEqual(row.revenue_total, 300.0, places=2)
+        self.assertAlmostEqual(row.margin_total, 100.0, places=2)
+
+        line.write({'product_id': product_chair.id})
+        self.env.cr.flush()
+
+        self.assertFalse(Analysis.search([('product_id', '=', self.product_desk.id)]))
+        row = Analysis.search([('product_id', '=', product_chair.id)])
+        self.assertAlmostEqual(row.revenue_total, 150.0, places=2)
+        self.assertAlmostEqual(row.margin_total, 50.0, places=2)
+
+        self.sale_order._action_cancel()
+        self.env.cr.flush()
+        self.assertFalse(Analysis.search([('product_id', '=', product_chair.id)]))
+
+    def test_28_currency_and_uom_conversion(self):
+        """
+        Test that the margin applies to the cost converted to the order
+        currency and the line UoM, with one rate lookup per currency and date.
+        Expected: price_unit = 100 * 12 (dozen) * 2 (rate) * 1.2 = 2880.0
+        """
+        company = self.env.company
+        currency = self.env['res.currency'].with_context(active_test=False).search(
+            [('id', '!=', company.currency_id.id)], limit=1,
+        )
+        currency.active = True
+        self.env['res.currency.rate'].create({
+            'name': '2000-01-01',
+            'rate': 2.0,
+            'currency_id': currency.id,
+            'company_id': company.id,
+        })
+        pricelist = self.env['product.pricelist'].create({
+            'name': 'Test Foreign Pricelist',
+            'currency_id': currency.id,
+        })
+        order = self.env['sale.order'].create({
+            'partner_id': self.partner.id,
+            'pricelist_id': pricelist.id,
+        })
+        self.assertEqual(order.currency_id, currency)
+
+        dozen = self.env.ref('uom.product_uom_dozen')
+        lines = self.env['sale.order.line'].create([{
+            'order_id': order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_id': dozen.id,
+            'product_uom_qty': qty,
+        } for qty in (1.0, 2.0, 3.0)])
+
+        for line in lines:
+            self.assertAlmostEqual(line.price_unit, 2880.0, places=2)
+        # All lines share one conversion rate, looked up once
+        Currency = self.env.registry['res.currency']
+        key = (self.env.company.currency_id.id, currency.id, self.env.company.id, order.date_order.date())
+        with patch.object(Currency, '_get_conversion_rate', autospec=True,
+                          side_effect=Currency._get_conversion_rate) as get_conversion_rate:
+            self.env['sale.line.margin.pricing']._get_conversion_rates([key] * 3)
+        self.assertEqual(get_conversion_rate.call_count, 1)
+
+        # Back to the product UoM: only the currency conversion remains
+        lines[0].write({'product_uom_id': self.product_desk.uom_id.id})
+        self.assertAlmostEqual(lines[0].price_unit, 240.0, places=2)
+
+        lines[1].write({'margin_percent': 50.0})
+        self.assertAlmostEqual(lines[1].price_unit, 3600.0, places=2)
+
+        # Cost propagation converts the new cost the same way
+        self.product_desk.standard_price = 50.0
+        self.assertAlmostEqual(lines[0].price_unit, 120.0, places=2)
+        self.assertAlmostEqual(lines[2].price_unit, 1440.0, places=2)
+
+    def test_29_margin_amount_search(self):
+        """
+        Test that the stored margin amount follows price, cost and quantity
+        and can be searched like margin_percent.
+        Expected: margin_amount = (120 - 100) * 2 = 40.0
+        """
+        Line = self.env['sale.order.line']
+        line = Line.create({
+            'order_id': self.sale_order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': 2.0,
+        })
+        self.assertAlmostEqual(line.margin_amount, 40.0, places=2)
+
+        line.write({'margin_percent': -10.0})
+        self.assertAlmostEqual(line.margin_amount, -20.0, places=2)
+
+        self.product_desk.standard_price = 50.0
+        self.assertAlmostEqual(line.margin_amount, -10.0, places=2)
+
+        self.assertIn(line, Line.search([('margin_amount', '<', 0)]))
+        self.assertIn(line, Line.search([('margin_percent', '<', 10), ('state', 'in', ('draft', 'sent'))]))
+        self.assertEqual(Line.search([('order_id', '=', self.sale_order.id)], order='cost_price desc')[:1], line)
+
+    def test_30_saved_margin_price(self):
+        """
+        Test the margin cost of a line, and that a margin price saved
+        together with the margin, as after the margin onchange, stays
+        automatic in computed price mode.
+        """
+        self.env['ir.config_parameter'].sudo().set_param('sale_line_margin_price.price_mode', 'compute')
+        line = self.env['sale.order.line'].create({
+            'order_id': self.sale_order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': 1.0,
+        })
+        self.assertAlmostEqual(line.margin_unit_cost, 100.0, places=2)
+
+        # As saved by the web client after a margin edit
+        line.write({'margin_percent': 35.0, 'price_unit': 135.0, 'margin_price_manual': False})
+        self.assertFalse(line.margin_price_manual)
+        self.assertAlmostEqual(line.price_unit, 135.0, places=2)
+
+        # A later cost change still reprices the line
+        self.product_desk.standard_price = 200.0
+        self.assertAlmostEqual(line.price_unit, 270.0, places=2)
+
+    def test_31_install_hook_fill(self):
+        """
+        Test that the post-install fill of cost_price and margin_amount in
+        SQL chunks gives the values the ORM computes, including for lines
+        sold in another UoM and lines without product.
+        """
+        Line = self.env['sale.order.line']
+        lines = Line.create([{
+            'order_id': self.sale_order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': qty,
+            'margin_percent': 10.0 * qty,
+        } for qty in range(1, 20)])
+        lines += Line.create({
+            'order_id': self.sale_order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_id': self.env.ref('uom.product_uom_dozen').id,
+            'product_uom_qty': 1.0,
+        })
+        lines += Line.create({
+            'order_id': self.sale_order.id,
+            'display_type': 'line_note',
+            'name': 'Note',
+        })
+        expected = {line.id: (line.cost_price, line.margin_amount) for line in lines}
+        self.env.flush_all()
+
+        self.env.cr.execute(SQL(
+            "UPDATE sale_order_line SET cost_price = NULL, margin_amount = NULL WHERE id IN %s",
+            tuple(lines.ids),
+        ))
+        self.env.invalidate_all()
+        _fill_cost_price(self.env, chunk_size=7)
+        _fill_margin_amount(self.env, chunk_size=7)
+
+        for line in lines:
+            cost_price, margin_amount = expected[line.id]
+            self.assertAlmostEqual(line.cost_price, cost_price, places=2)
+            self.assertAlmostEqual(line.margin_amount, margin_amount, places=2)
+
+    def test_32_target_margin(self):
+        """
+        Test that solving an order for a target margin reaches it with both
+        methods, keeps locked lines at their price and rounds the margins,
+        that it requires write access to the order and its lines, and that
+        it is refused when margin prices are combined with pricelists.
+        """
+        product_chair = self.env['product.product'].create({
+            'name': 'Test Chair',
+            'type': 'consu',
+            'standard_price': 50.0,
+        })
+        Line = self.env['sale.order.line']
+        desk_line, chair_line, locked_line = Line.create([{
+            'order_id': self.sale_order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': 2.0,
+            'margin_percent': 10.0,
+        }, {
+            'order_id': self.sale_order.id,
+            'product_id': product_chair.id,
+            'product_uom_qty': 4.0,
+            'margin_percent': 30.0,
+        }, {
+            'order_id': self.sale_order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': 1.0,
+            'margin_percent': 50.0,
+        }])
+
+        result = self.sale_order.apply_target_margin(25.0, locked_lines=locked_line)
+        self.assertEqual(result['lines'], 2)
+        self.assertAlmostEqual(result['margin'], 25.0, delta=0.01)
+        self.assertAlmostEqual(locked_line.price_unit, 150.0, places=2)
+        self.assertAlmostEqual(desk_line.margin_percent, chair_line.margin_percent, places=6)
+        self.assertAlmostEqual(desk_line.price_unit, 100.0 * (1 + desk_line.margin_percent / 100), places=2)
+        self.assertAlmostEqual(desk_line.margin_amount, desk_line.price_subtotal - 200.0, places=2)
+
+        # Shifting keeps the 20 points between the two free lines
+        desk_line.write({'margin_percent': 10.0})
+        chair_line.write({'margin_percent': 30.0})
+        result = self.sale_order.apply_target_margin(
+            40.0, locked_lines=locked_line, method='shift', margin_rounding=0.5,
+        )
+        self.assertAlmostEqual(result['margin'], 40.0, delta=0.5)
+        self.assertEqual(desk_line.margin_percent % 0.5, 0.0)
+        self.assertEqual(chair_line.margin_percent % 0.5, 0.0)
+
+        # The numpy kernel and the pure Python solver agree
+        pricing = self.env['sale.line.margin.pricing']
+        args = ([200.0, 200.0, 0.5], [10.0, 30.0, 0.0], 600.0)
+        for method in ('uniform', 'shift'):
+            for solved, expected in zip(
+                pricing._solve_target_margins(*args, method=method, margin_rounding=0.5),
+                pricing._solve_target_margins_loop(*args, method=method, margin_rounding=0.5),
+            ):
+                self.assertAlmostEqual(solved, expected, places=6)
+
+        # The solver prices at the plain margin price, not combined with pricelists
+        self.env['ir.config_parameter'].sudo().set_param('sale_line_margin_price.pricelist_mode', 'floor')
+        with self.assertRaises(UserError):
+            self.sale_order.apply_target_margin(25.0)
+        self.env['ir.config_parameter'].sudo().set_param('sale_line_margin_price.pricelist_mode', 'margin')
+
+        # Salespersons only reaching their own documents cannot reprice others'
+        salesman = new_test_user(self.env, login='margin_salesman', groups='sales_team.group_sale_salesman')
+        self.sale_order.user_id = self.env.ref('base.user_admin')
+        with self.assertRaises(AccessError):
+            self.sale_order.with_user(salesman).apply_target_margin(25.0)
+        with self.assertRaises(AccessError):
+            desk_line.with_user(salesman)._write_margin_prices([25.0], [100.0])
+
+        self.sale_order.action_confirm()
+        with self.assertRaises(UserError):
+            self.sale_order.apply_target_margin(25.0)
+
+    def test_33_pricelist_modes(self):
+        """
+        Test the margin price as a floor of, and as an adjustment on top of,
+        the pricelist price, and that pricelist rules are evaluated once per
+        quantity bracket for a whole batch of lines.
+        """
+        ICP = self.env['ir.config_parameter'].sudo()
+        pricelist = self.env['product.pricelist'].create({
+            'name': 'Test Margin Pricelist',
+            'item_ids': [(0, 0, {
+                'applied_on': '0_product_variant',
+                'product_id': self.product_desk.id,
+                'compute_price': 'fixed',
+                'fixed_price': 200.0,
+            }), (0, 0, {
+                'applied_on': '0_product_variant',
+                'product_id': self.product_desk.id,
+                'compute_price': 'fixed',
+                'fixed_price': 110.0,
+                'min_quantity': 10.0,
+            })],
+        })
+        order = self.env['sale.order'].create({
+            'partner_id': self.partner.id,
+            'pricelist_id': pricelist.id,
+        })
+
+        def create_line(quantity, margin_percent=20.0):
+            return self.env['sale.order.line'].create({
+                'order_id': order.id,
+                'product_id': self.product_desk.id,
+                'product_uom_qty': quantity,
+                'margin_percent': margin_percent,
+            })
+
+        ICP.set_param('sale_line_margin_price.pricelist_mode', 'floor')
+        self.assertAlmostEqual(create_line(1.0).price_unit, 200.0, places=2)
+        bulk_line = create_line(10.0)
+        self.assertAlmostEqual(bulk_line.price_unit, 120.0, places=2, msg="The margin price is the floor")
+        bulk_line.write({'margin_percent': 5.0})
+        self.assertAlmostEqual(bulk_line.price_unit, 110.0, places=2)
+
+        ICP.set_param('sale_line_margin_price.pricelist_mode', 'adjust')
+        self.assertAlmostEqual(create_line(1.0, 10.0).price_unit, 220.0, places=2)
+        # Cost changes reprice through the pricelist too
+        bulk_line.write({'margin_percent': 50.0})
+        self.assertAlmostEqual(bulk_line.price_unit, 165.0, places=2)
+        self.product_desk.standard_price = 90.0
+        self.assertAlmostEqual(bulk_line.price_unit, 165.0, places=2)
+
+        # 3000 lines in 2 quantity brackets: below 10 units and from 10 units
+        pricing = self.env['sale.line.margin.pricing']
+        company = self.env.company
+        items = [
+            (pricelist, self.product_desk, company, order.currency_id, self.product_desk.uom_id, quantity, order.date_order)
+            for quantity in [1.0, 5.0, 12.0] * 1000
+        ]
+        Pricelist = self.env.registry['product.pricelist']
+        with patch.object(Pricelist, '_compute_price_rule', autospec=True,
+                          side_effect=Pricelist._compute_price_rule) as compute_price_rule:
+            prices = pricing._get_pricelist_prices(items)
+        self.assertEqual(compute_price_rule.call_count, 2)
+        self.assertEqual(prices[:3], [200.0, 200.0, 110.0])
+
+    def test_34_simulate_margin_prices(self):
+        """
+        Test that the pricing simulation gives the prices order lines would
+        get, for explicit and rule margins, without creating any record.
+        """
+        self.env['sale.margin.rule'].create({
+            'name': 'Desk margin',
+            'product_id': self.product_desk.id,
+            'margin_percent': 40.0,
+        })
+        dozen = self.env.ref('uom.product_uom_dozen')
+        Line = self.env['sale.order.line']
+        line_count = Line.search_count([])
+
+        results = self.env['sale.line.margin.pricing'].simulate_margin_prices([
+            {'product_id': self.product_desk.id, 'quantity': 2.0, 'margin_percent': 50.0},
+            {'product_id': self.product_desk.id},
+            {'product_id': self.product_desk.id, 'uom_id': dozen.id, 'margin_percent': 0.0},
+            {'product_id': self.product_zero_cost.id, 'margin_percent': 50.0},
+        ])
+
+        self.assertEqual(Line.search_count([]), line_count)
+        self.assertAlmostEqual(results[0]['price'], 150.0, places=2)
+        self.assertAlmostEqual(results[0]['margin_amount'], 100.0, places=2)
+        self.assertEqual(results[1]['margin_percent'], 40.0, "Margin rules apply when no margin is given")
+        self.assertAlmostEqual(results[1]['price'], 140.0, places=2)
+        self.assertAlmostEqual(results[2]['cost'], 1200.0, places=2)
+        self.assertAlmostEqual(results[2]['price'], 1200.0, places=2)
+        self.assertEqual(results[3]['cost'], 0.0)
+        self.assertEqual(results[3]['currency_id'], self.env.company.currency_id.id)
+
+        line = Line.create({
+            'order_id': self.sale_order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': 2.0,
+            'margin_percent': 50.0,
+        })
+        self.assertAlmostEqual(line.price_unit, results[0]['price'], places=2)
+
+        with self.assertRaises(UserError):
+            self.env['sale.line.margin.pricing'].simulate_margin_prices([{'product_id': 0}])
+
+    def test_35_batched_amounts_recompute(self):
+        """
+        Test that a margin update repricing 1000 lines in several price
+        groups computes the line taxes and the order totals once, in batch,
+        at flush time.
+        """
+        order = self.env['sale.order'].create({'partner_id': self.partner.id})
+        self.env['sale.order.line'].create([{
+            'order_id': order.id,
+            'product_id': (self.product_desk if index % 2 else self.product_zero_cost).id,
+            'product_uom_qty': 1.0,
+        } for index in range(1000)])
+        self.env.flush_all()
+        lines = order.order_line
+
+        Line = self.env.registry['sale.order.line']
+        Order = self.env.registry['sale.order']
+        with patch.object(Line, '_compute_amount', autospec=True,
+                          side_effect=Line._compute_amount) as compute_line_amount, \
+             patch.object(Order, '_compute_amounts', autospec=True,
+                          side_effect=Order._compute_amounts) as compute_order_amounts:
+            lines.write({'margin_percent': 50.0})
+            self.env.flush_all()
+
+        self.assertEqual(compute_line_amount.call_count, 1, "Line taxes are computed in one batch")
+        self.assertEqual(len(compute_line_amount.call_args.args[0]), 1000)
+        self.assertEqual(compute_order_amounts.call_count, 1, "Order totals are computed once")
+        self.assertAlmostEqual(order.amount_untaxed, 500 * 150.0, places=2)
+        self.assertAlmostEqual(sum(lines.mapped('margin_amount')), 500 * 50.0, places=2)
+
+    def test_36_concurrent_margin_updates(self):
+        """
+        Test that margin-only writes in the concurrent update mode price the
+        lines as the default write does, and that repeating them does not
+        write the lines again.
+        """
+        self.env['ir.config_parameter'].sudo().set_param('sale_line_margin_price.concurrent_updates', True)
+        order = self.env['sale.order'].create({'partner_id': self.partner.id})
+        lines = self.env['sale.order.line'].create([{
+            'order_id': order.id,
+            'product_id': product.id,
+            'product_uom_qty': 2.0,
+        } for product in (self.product_desk, self.product_desk, self.product_zero_cost)])
+        self.env.flush_all()
+
+        queries_before = self.env.cr.sql_log_count
+        lines.write({'margin_percent': 50.0})
+        self.env.flush_all()
+        first_write_queries = self.env.cr.sql_log_count - queries_before
+        self.assertEqual(lines.mapped('margin_percent'), [50.0] * 3)
+        self.assertEqual(lines.mapped('price_unit'), [150.0, 150.0, 0.0])
+        self.assertAlmostEqual(order.amount_untaxed, 600.0, places=2)
+
+        # A retried or duplicate request finds the lines up to date
+        queries_before = self.env.cr.sql_log_count
+        lines.write({'margin_percent': 50.0})
+        self.env.flush_all()
+        self.assertLess(self.env.cr.sql_log_count - queries_before, first_write_queries)
+
+        # Lines of confirmed orders keep their price
+        order.action_confirm()
+        lines.write({'margin_percent': 10.0})
+        self.assertEqual(lines.mapped('margin_percent'), [10.0] * 3)
+        self.assertEqual(lines.mapped('price_unit'), [150.0, 150.0, 0.0])
+
+    def test_37_margin_export_rows(self):
+        """
+        Test that the margin export reads the filtered lines in batches of
+        the requested size, with their margin data.
+        """
+        order = self.env['sale.order'].create({'partner_id': self.partner.id})
+        self.env['sale.order.line'].create([{
+            'order_id': order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': 1.0,
+            'margin_percent': margin,
+        } for margin in (10.0, 20.0, 30.0, 40.0, 50.0)])
+
+        batches = list(self.env['sale.order.line']._iter_margin_export_rows(
+            [('order_id', '=', order.id), ('margin_percent', '>=', 20.0)], batch_size=2,
+        ))
+        self.assertEqual([len(rows) for rows in batches], [2, 2])
+        rows = [row for rows in batches for row in rows]
+        self.assertEqual({row[0] for row in rows}, {order.name})
+        self.assertEqual(rows[0][4], 'Test Desk')
+        # Cost, margin %, unit price and margin of the 20% line
+        self.assertEqual(rows[0][6:9], (100.0, 20.0, 120.0))
+        self.assertAlmostEqual(float(rows[0][10]), 20.0, places=2)
+
+    def test_38_confirmed_cost_snapshot(self):
+        """
+        Test that confirming an order freezes the cost of its lines, so that
+        their margin no longer follows the product cost, and that resetting
+        it to quotation releases the cost again.
+        """
+        order = self.env['sale.order'].create({'partner_id': self.partner.id})
+        lines = self.env['sale.order.line'].create([{
+            'order_id': order.id,
+            'product_id': product.id,
+            'product_uom_qty': 2.0,
+            'margin_percent': 50.0,
+        } for product in (self.product_desk, self.product_zero_cost)])
+        order.action_confirm()
+        self.assertEqual(lines.mapped('confirmed_cost_price'), [100.0, 0.0])
+        self.assertEqual(lines.mapped('cost_confirmed'), [True, True])
+        self.assertAlmostEqual(lines[0].margin_amount, 100.0, places=2)
+        zero_cost_margin = lines[1].margin_amount
+
+        # The cost is reloaded from the product, e.g. by a reinstallation
+        self.product_desk.standard_price = 130.0
+        self.product_zero_cost.standard_price = 25.0
+        _fill_cost_price(self.env)
+        self.env['sale.order.line'].browse(lines.ids).modified(['cost_price'])
+        self.assertEqual(lines.mapped('cost_price'), [130.0, 25.0])
+        self.assertAlmostEqual(lines[0].margin_amount, 100.0, places=2, msg="The margin keeps the confirmed cost")
+        self.assertAlmostEqual(lines[1].margin_amount, zero_cost_margin, places=2,
+                               msg="A confirmed cost of zero is a snapshot too")
+        _fill_margin_amount(self.env)
+        self.env.invalidate_all()
+        self.assertAlmostEqual(lines[1].margin_amount, zero_cost_margin, places=2)
+
+        self.env['sale.margin.analysis']._rebuild()
+        analysis = self.env['sale.margin.analysis'].search([('product_id', '=', self.product_desk.id)])
+        self.assertAlmostEqual(sum(analysis.mapped('cost_total')), 200.0, places=2)
+
+        order._action_cancel()
+        order.action_draft()
+        self.assertEqual(lines.mapped('confirmed_cost_price'), [0.0, 0.0])
+        self.assertEqual(lines.mapped('cost_confirmed'), [False, False])
+        self.assertAlmostEqual(lines[0].margin_amount, 40.0, places=2)
+
+    def test_39_quotation_template_margins(self):
+        """
+        Test that the lines of a quotation template are priced at their
+        template margin, 0% included, or the margin rule's when the template
+        line uses it, when the template is selected on a quotation and when
+        it is applied in batch. Quotations without template keep their lines.
+        """
+        self.env['sale.margin.rule'].create({
+            'name': 'Desks',
+            'product_id': self.product_desk.id,
+            'margin_percent': 40.0,
+        })
+        template = self.env['sale.order.template'].create({
+            'name': 'Margin Template',
+            'sale_order_template_line_ids': [
+                (0, 0, {'display_type': 'line_section', 'name': 'Furniture'}),
+                (0, 0, {'product_id': self.product_desk.id, 'product_uom_qty': 2.0, 'margin_percent': 30.0}),
+                (0, 0, {'product_id': self.product_desk.id, 'product_uom_qty': 1.0}),
+                (0, 0, {'product_id': self.product_desk.id, 'product_uom_qty': 1.0, 'margin_percent': 0.0}),
+            ],
+        })
+
+        order = self.env['sale.order'].new({'partner_id': self.partner.id, 'sale_order_template_id': template.id})
+        order._onchange_sale_order_template_id()
+        product_lines = order.order_line.filtered('product_id')
+        self.assertEqual(product_lines.mapped('margin_percent'), [30.0, 40.0, 0.0])
+        self.assertEqual(product_lines.mapped('price_unit'), [130.0, 140.0, 100.0])
+
+        own_line = self.env['sale.order.line'].create({
+            'order_id': self.sale_order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': 1.0,
+        })
+        self.assertFalse(self.sale_order._apply_margin_template())
+        self.assertEqual(self.sale_order.order_line, own_line)
+
+        Pricing = self.env.registry['sale.line.margin.pricing']
+        with patch.object(Pricing, '_get_costs', autospec=True, side_effect=Pricing._get_costs) as get_costs:
+            lines = self.sale_order._apply_margin_template(template)
+        self.assertEqual(get_costs.call_count, 1, "Costs are read once for all lines")
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(self.sale_order.order_line, lines)
+        self.assertEqual(lines.filtered('product_id').mapped('margin_percent'), [30.0, 40.0, 0.0])
+        self.assertEqual(lines.filtered('product_id').mapped('price_unit'), [130.0, 140.0, 100.0])
+
+        self.sale_order.action_confirm()
+        with self.assertRaises(UserError):
+            self.sale_order._apply_margin_template(template)
+
+    def test_41_reprice_in_worker_threads(self):
+        """
+        Test the parallel re-pricing path: chunks are processed and committed
+        on worker cursors, and a failing chunk is rolled back on its own
+        while the other chunks keep their new prices.
+        """
+        orders = self.env['sale.order'].create([{'partner_id': self.partner.id} for _i in range(3)])
+        lines = self.env['sale.order.line'].create([{
+            'order_id': order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': 1.0,
+            'margin_percent': 30.0,
+        } for order in orders])
+        lines.write({'price_unit': 99.0, 'margin_price_manual': False})
+        self.env.flush_all()
+
+        # Worker cursors share the test transaction in test mode
+        self.registry.enter_test_mode(self.env.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+
+        Repricing = self.env.registry['sale.line.margin.repricing']
+        reprice_orders = Repricing._reprice_orders
+
+        def reprice_or_fail(repricing, order_ids):
+            count = reprice_orders(repricing, order_ids)
+            if orders[1].id in order_ids:
+                raise UserError("Chunk failure")
+            return count
+
+        with patch.object(Repricing, '_reprice_orders', autospec=True, side_effect=reprice_or_fail), \
+             patch.object(Repricing, '_reprice_orders_in_new_cursor', autospec=True,
+                          side_effect=Repricing._reprice_orders_in_new_cursor) as in_new_cursor, \
+             self.assertRaises(UserError):
+            self.env['sale.line.margin.repricing'].reprice_open_quotations(
+                order_ids=orders.ids, workers=2, chunk_size=1,
+            )
+        self.assertEqual(in_new_cursor.call_count, 3)
+
+        self.env.invalidate_all()
+        self.assertEqual(lines.mapped('price_unit'), [130.0, 99.0, 130.0])
+
+    def test_42_public_calls_query_budget(self):
+        """
+        Test that the user-facing create(), margin write() and order
+        confirmation issue the same number of queries for 10 and 100 lines.
+        """
+        def count_queries(func, *args):
+            self.env.flush_all()
+            self.env.invalidate_all()
+            queries_before = self.env.cr.sql_log_count
+            func(*args)
+            self.env.flush_all()
+            return self.env.cr.sql_log_count - queries_before
+
+        counts = {}
+        for size in (10, 100):
+            order = self.env['sale.order'].create({'partner_id': self.partner.id})
+            vals_list = [{
+                'order_id': order.id,
+                'product_id': self.product_desk.id,
+                'product_uom_qty': 1.0 + i % 3,
+            } for i in range(size)]
+            Line = self.env['sale.order.line']
+            create_count = count_queries(Line.create, vals_list)
+            lines = order.order_line
+            write_count = count_queries(lines.write, {'margin_percent': 35.0})
+            confirm_count = count_queries(order.action_confirm)
+            counts[size] = (create_count, write_count, confirm_count)
+            self.assertEqual(lines.mapped('price_unit'), [135.0] * size)
+
+        for operation, small, large in zip(('create', 'write', 'action_confirm'), counts[10], counts[100]):
+            self.assertEqual(small, large, msg=f"{operation} on 100 lines should not issue more queries than on 10")
+
+    def test_43_rule_changes_invalidate_their_company(self):
+        """
+        Test that a margin rule change only invalidates the rule index of the
+        companies the rule applies to, and that new margins apply at once.
+        """
+        company = self.env.company
+        other_company = self.env['res.company'].create({'name': 'Test Other Margin Company'})
+        Rule = self.env['sale.margin.rule']
+        versions = lambda: (company.margin_rule_version, other_company.margin_rule_version)
+
+        before = versions()
+        rule = Rule.create({
+            'name': 'Desks',
+            'product_id': self.product_desk.id,
+            'margin_percent': 40.0,
+            'company_id': company.id,
+        })
+        self.assertEqual(versions(), (before[0] + 1, before[1]))
+        items = [(self.product_desk.id, self.partner.id, False, False)]
+        self.assertEqual(Rule._resolve_margin_percents(items, company), [40.0])
+        self.assertEqual(Rule._resolve_margin_percents(items, other_company), [None])
+
+        before = versions()
+        rule.margin_percent = 45.0
+        self.assertEqual(versions(), (before[0] + 1, before[1]))
+        self.assertEqual(Rule._resolve_margin_percents(items, company), [45.0])
+
+        before = versions()
+        rule.company_id = False
+        self.assertEqual(versions(), (before[0] + 1, before[1] + 1))
+        self.assertEqual(Rule._resolve_margin_percents(items, other_company), [45.0])
+
+        before = versions()
+        rule.unlink()
+        self.assertEqual(versions(), (before[0] + 1, before[1] + 1))
+        self.assertEqual(Rule._resolve_margin_percents(items, company), [None])
+
+    def test_44_margin_analysis_uom_and_refresh(self):
+        """
+        Test that the margin analysis costs lines sold in another UoM in
+        that UoM, and that refreshing a group again updates its single row.
+        """
+        Analysis = self.env['sale.margin.analysis']
+        line = self.env['sale.order.line'].create({
+            'order_id': self.sale_order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_id': self.env.ref('uom.product_uom_dozen').id,
+            'product_uom_qty': 2.0,
+            'margin_percent': 20.0,
+        })
+        self.env.cr.flush()
+
+        row = Analysis.search([('product_id', '=', self.product_desk.id)])
+        self.assertEqual(len(row), 1)
+        self.assertAlmostEqual(row.cost_total, 2400.0, places=2)
+        self.assertAlmostEqual(row.revenue_total, 2880.0, places=2)
+        self.assertAlmostEqual(row.margin_total, 480.0, places=2)
+
+        groups = Analysis._get_line_groups(line.ids)
+        Analysis._refresh_groups(groups)
+        line.product_uom_qty = 1.0
+        Analysis._refresh_groups(groups)
+        row = Analysis.search([('product_id', '=', self.product_desk.id)])
+        self.assertEqual(len(row), 1)
+        self.assertAlmostEqual(row.cost_total, 1200.0, places=2)
+
+        line.unlink()
+        Analysis._refresh_groups(groups)
+        self.assertFalse(Analysis.search([('product_id', '=', self.product_desk.id)]))
+
+    def test_45_client_prices_are_not_manual(self):
+        """
+        Test that the prices the web client saves from the onchanges, which
+        come without margin_price_manual, are not flagged as manual, while
+        other prices are, on create and on a product change.
+        """
+        product_chair = self.env['product.product'].create({
+            'name': 'Test Chair',
+            'type': 'consu',
+            'standard_price': 50.0,
+        })
+        Line = self.env['sale.order.line']
+        line, line_manual = Line.create([{
+            'order_id': self.sale_order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': 1.0,
+            'margin_percent': 20.0,
+            'price_unit': 120.0,
+        }, {
+            'order_id': self.sale_order.id,
+            'product_id': self.product_desk.id,
+            'product_uom_qty': 1.0,
+            'margin_percent': 20.0,
+            'price_unit': 110.0,
+        }])
+        self.assertFalse(line.margin_price_manual)
+        self.assertTrue(line_manual.margin_price_manual)
+
+        # As saved after a product swap: the onchange price, without the flag
+        line.write({
+            'product_id': product_chair.id,
+            'name': product_chair.display_name,
+            'product_uom_id': product_chair.uom_id.id,
+            'price_unit': 60.0,
+        })
+        self.assertFalse(line.margin_price_manual)
+
+        product_chair.standard_price = 80.0
+        self.assertAlmostEqual(line.price_unit, 96.0, places=2)
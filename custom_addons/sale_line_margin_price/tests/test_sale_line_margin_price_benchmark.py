@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+
+from psycopg2 import errorcodes
+
+from odoo import SUPERUSER_ID, api
+from odoo.service.model import retrying
+from odoo.tests.common import TransactionCase
+from odoo.tests import tagged
+from odoo.tools import SQL, float_round
+
+from ..hooks import _fill_cost_price, _fill_margin_amount
+
+_logger = logging.getLogger(__name__)
+
+# Order sizes (number of lines) to benchmark, overridable as "100,1000"
+BENCHMARK_SIZES_ENV = 'SALE_MARGIN_BENCHMARK_SIZES'
+DEFAULT_BENCHMARK_SIZES = (100, 1000, 10000)
+# Where the machine-readable results are written
+BENCHMARK_OUTPUT_ENV = 'SALE_MARGIN_BENCHMARK_OUTPUT'
+
+# Records are read by the ORM in prefetch batches of this size
+PREFETCH_BATCH_SIZE = 1000
+
+# Number of order lines of the margin search benchmark table
+INDEX_BENCHMARK_ROWS_ENV = 'SALE_MARGIN_BENCHMARK_INDEX_ROWS'
+DEFAULT_INDEX_BENCHMARK_ROWS = 2000000
+# Number of order lines of the install hook benchmark table
+INSTALL_BENCHMARK_ROWS_ENV = 'SALE_MARGIN_BENCHMARK_INSTALL_ROWS'
+DEFAULT_INSTALL_BENCHMARK_ROWS = 1000000
+# Number of lines of the quotation edited concurrently, and of its editors
+CONCURRENT_BENCHMARK_LINES_ENV = 'SALE_MARGIN_BENCHMARK_CONCURRENT_LINES'
+DEFAULT_CONCURRENT_BENCHMARK_LINES = 1000
+CONCURRENT_BENCHMARK_USERS_ENV = 'SALE_MARGIN_BENCHMARK_CONCURRENT_USERS'
+DEFAULT_CONCURRENT_BENCHMARK_USERS = 8
+
+
+@tagged('post_install', '-at_install', '-standard', 'sale_line_margin_price_benchmark')
+class TestSaleLineMarginPriceBenchmark(TransactionCase):
+    """
+    Benchmarks of the margin pricing hot paths.
+    Not part of the standard test run, select them with:
+    --test-tags sale_line_margin_price_benchmark
+
+    Wall time and SQL query counts of each measured operation are written
+    as JSON to $SALE_MARGIN_BENCHMARK_OUTPUT (default: a file in the system
+    temporary directory) so that runs can be compared.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.results = []
+
+        cls.partner = cls.env['res.partner'].create({
+            'name': 'Benchmark Customer',
+        })
+        cls.products = cls.env['product.product'].create([{
+            'name': f'Benchmark Product {i}',
+            'type': 'consu',
+            'standard_price': 10.0 + i,
+        } for i in range(50)])
+
+    @classmethod
+    def tearDownClass(cls):
+        output = os.environ.get(BENCHMARK_OUTPUT_ENV) or os.path.join(
+            tempfile.gettempdir(), 'sale_line_margin_price_benchmark.json',
+        )
+        with open(output, 'w') as f:
+            json.dump({'created': time.time(), 'results': cls.results}, f, indent=2)
+        _logger.info("Margin pricing benchmark results written to %s", output)
+        super().tearDownClass()
+
+    def _get_sizes(self):
+        sizes = os.environ.get(BENCHMARK_SIZES_ENV)
+        if not sizes:
+            return DEFAULT_BENCHMARK_SIZES
+        return tuple(int(size) for size in sizes.split(','))
+
+    def _timeit(self, func, *args):
+        """Run func(*args), return (result, elapsed seconds)"""
+        start = time.perf_counter()
+        result = func(*args)
+        return result, time.perf_counter() - start
+
+    def _measure(self, operation, size, func, *args):
+        """
+        Run func(*args) on a cold cache, flushing its pending updates, and
+        record its wall time and query count under operation.
+        """
+        self.env.flush_all()
+        self.env.invalidate_all()
+        queries_before = self.env.cr.sql_log_count
+        start = time.perf_counter()
+        result = func(*args)
+        self.env.flush_all()
+        elapsed = time.perf_counter() - start
+        queries = self.env.cr.sql_log_count - queries_before
+
+        self.results.append({
+            'operation': operation,
+            'size': size,
+            'seconds': elapsed,
+            'queries': queries,
+        })
+        _logger.info("%s, %s lines: %.3fs, %s queries", operation, size, elapsed, queries)
+        return result
+
+    def _prepare_vals_list(self, order, size):
+        return [{
+            'order_id': order.id,
+            'product_id': self.products[i % len(self.products)].id,
+            'product_uom_qty': 1.0,
+            'margin_percent': 20.0 + i % 10,
+        } for i in range(size)]
+
+    def _clone_lines(self, order, rows, overrides=None):
+        """
+        Insert copies of the lines of order in SQL until about rows lines
+        were added, return the elapsed seconds.
+
+        :param dict overrides: {column: SQL expression} replacing the copied
+            values, clone.n being the copy number
+        """
+        overrides = overrides or {}
+        source_count = len(order.order_line)
+        self.env.flush_all()
+        self.env.cr.execute(SQL(
+            """
+            SELECT column_name
+              FROM information_schema.columns
+             WHERE table_name = 'sale_order_line' AND column_name != 'id'
+            """
+        ))
+        columns = [row[0] for row in self.env.cr.fetchall()]
+        _result, elapsed = self._timeit(self.env.cr.execute, SQL(
+            """
+            INSERT INTO sale_order_line (%s)
+            SELECT %s
+              FROM sale_order_line line
+             CROSS JOIN generate_series(1, %s) AS clone(n)
+             WHERE line.order_id = %s
+            """,
+            SQL(", ").join(SQL.identifier(column) for column in columns),
+            SQL(", ").join(overrides.get(column) or SQL.identifier('line', column) for column in columns),
+            math.ceil(rows / source_count),
+            order.id,
+        ))
+        self.env.invalidate_all()
+        return elapsed
+
+    def test_margin_pricing_hot_paths(self):
+        """
+        Measure create, margin write, product cost write, cost_price
+        computation and confirmation on orders of increasing size, and
+        enforce query budgets on the module's own pricing paths.
+        """
+        Line = self.env['sale.order.line']
+        for size in self._get_sizes():
+            # Prefetching reads records in batches, budgets scale with them
+            prefetch_batches = math.ceil(size / PREFETCH_BATCH_SIZE)
+            order = self.env['sale.order'].create({
+                'partner_id': self.partner.id,
+            })
+            vals_list = self._prepare_vals_list(order, size)
+
+            # Pricing a create() vals_list: orders, product costs and product UoMs
+            self.env.invalidate_all()
+            with self.assertQueryCount(4):
+                Line._prepare_margin_price_vals([dict(vals) for vals in vals_list])
+
+            lines = self._measure('create', size, Line.create, vals_list)
+
+            # Grouping lines by margin price: lines, orders, product costs and UoMs
+            self.env.invalidate_all()
+            with self.assertQueryCount(3 + 2 * prefetch_batches):
+                lines._group_lines_by_margin_price({'margin_percent': 35.0})
+
+            self._measure('write_margin', size, lines.write, {'margin_percent': 35.0})
+
+            self._measure('write_product_cost', size, self.products[0].write, {'standard_price': 42.0})
+
+            # Recomputing cost_price: line products and their costs
+            self.env.invalidate_all()
+            with self.assertQueryCount(2 + prefetch_batches):
+                lines._compute_cost_price()
+            self._measure('compute_cost_price', size, lines._compute_cost_price)
+
+            self._measure('confirm', size, order.action_confirm)
+            self.assertEqual(order.state, 'sale')
+
+    def test_pricing_kernel_vs_loop(self):
+        """
+        Compare the vectorized pricing kernel with the per-record scalar
+        loop at 10k and 100k lines.
+        """
+        pricing = self.env['sale.line.margin.pricing']
+        rounding = 0.01
+        rng = random.Random(42)
+
+        for size in (10000, 100000):
+            costs = [rng.uniform(0.0, 1000.0) for _i in range(size)]
+            margins = [rng.uniform(-20.0, 200.0) for _i in range(size)]
+
+            def scalar_loop():
+                return [
+                    float_round(pricing._compute_margin_price(cost, margin), precision_rounding=rounding)
+                    for cost, margin in zip(costs, margins)
+                ]
+
+            expected, loop_time = self._timeit(scalar_loop)
+            prices, kernel_time = self._timeit(pricing._compute_margin_prices, costs, margins, rounding)
+
+            self.assertEqual(len(prices), size)
+            for price, expected_price in zip(prices, expected):
+                self.assertAlmostEqual(price, expected_price, places=2)
+            self.results.extend([
+                {'operation': 'pricing_loop', 'size': size, 'seconds': loop_time},
+                {'operation': 'pricing_kernel', 'size': size, 'seconds': kernel_time},
+            ])
+            _logger.info(
+                "Margin pricing kernel, %s lines: loop %.3fs, kernel %.3fs (x%.1f)",
+                size, loop_time, kernel_time, loop_time / kernel_time if kernel_time else 0.0,
+            )
+
+    def test_price_modes(self):
+        """
+        Compare the queries of creating lines and editing their margin in
+        the onchange/save price mode and in the computed price mode.
+        """
+        Line = self.env['sale.order.line']
+        ICP = self.env['ir.config_parameter'].sudo()
+        for size in self._get_sizes():
+            for mode in ('onchange', 'compute'):
+                ICP.set_param('sale_line_margin_price.price_mode', mode)
+                order = self.env['sale.order'].create({
+                    'partner_id': self.partner.id,
+                })
+                lines = self._measure(f'create_{mode}_mode', size, Line.create, self._prepare_vals_list(order, size))
+                self._measure(f'write_margin_{mode}_mode', size, lines.write, {'margin_percent': 35.0})
+
+                # Single line edit, as saved from the quotation form
+                self._measure(f'write_margin_one_line_{mode}_mode', 1, lines[0].write, {'margin_percent': 45.0})
+
+    def test_margin_search_index_scans(self):
+        """
+        Grow the order line table to $SALE_MARGIN_BENCHMARK_INDEX_ROWS rows
+        (default 2 million) by cloning lines in SQL, and check with EXPLAIN
+        that the margin filters and the cost sort of the search view use
+        index scans instead of sequential scans.
+        """
+        Line = self.env['sale.order.line']
+        rows = int(os.environ.get(INDEX_BENCHMARK_ROWS_ENV) or DEFAULT_INDEX_BENCHMARK_ROWS)
+        order = self.env['sale.order'].create({
+            'partner_id': self.partner.id,
+        })
+        Line.create(self._prepare_vals_list(order, 100))
+
+        # 1 line in 20 is a quotation line, margins and costs are spread out
+        clone_time = self._clone_lines(order, rows, {
+            'state': SQL("CASE WHEN clone.n %% 20 = 0 THEN 'draft' ELSE 'sale' END"),
+            'margin_percent': SQL("random() * 100"),
+            'cost_price': SQL("random() * 1000"),
+            'margin_amount': SQL("random() * 200 - 20"),
+        })
+        self.env.cr.execute(SQL("ANALYZE sale_order_line"))
+        _logger.info("Cloned order lines up to %s rows in %.1fs", rows, clone_time)
+
+        searches = {
+            'margin_below_10': ([('margin_percent', '<', 10)], None),
+            'quotation_margin_below_10': ([('margin_percent', '<', 10), ('state', 'in', ('draft', 'sent'))], None),
+            'negative_margin': ([('margin_amount', '<', 0)], None),
+            'sort_by_cost': ([], 'cost_price desc'),
+        }
+        for name, (domain, order_by) in searches.items():
+            query = Line._search(domain, limit=80, order=order_by)
+            self.env.cr.execute(SQL("EXPLAIN %s", query.select()))
+            plan = "\n".join(row[0] for row in self.env.cr.fetchall())
+            _logger.info("Margin search %s on %s lines:\n%s", name, rows, plan)
+            self.results.append({'operation': f'explain_{name}', 'size': rows, 'plan': plan})
+            self.assertIn('Index', plan, f"{name} should use an index scan")
+            self.assertNotIn('Seq Scan on sale_order_line', plan, f"{name} should not scan the whole table")
+
+    def test_install_hook_fill(self):
+        """
+        Fill cost_price and margin_amount of $SALE_MARGIN_BENCHMARK_INSTALL_ROWS
+        lines (default 1 million) as the post-install hook does, and check
+        that the number of queries depends on the number of chunks only.
+        """
+        rows = int(os.environ.get(INSTALL_BENCHMARK_ROWS_ENV) or DEFAULT_INSTALL_BENCHMARK_ROWS)
+        order = self.env['sale.order'].create({
+            'partner_id': self.partner.id,
+        })
+        self.env['sale.order.line'].create(self._prepare_vals_list(order, 100))
+        self._clone_lines(order, rows, {
+            'cost_price': SQL("NULL"),
+            'margin_amount': SQL("NULL"),
+        })
+
+        self.env.cr.execute(SQL("SELECT MAX(id) - MIN(id) FROM sale_order_line"))
+        chunks = math.ceil((self.env.cr.fetchone()[0] + 1) / 100000)
+        self._measure('install_fill_cost_price', rows, _fill_cost_price, self.env, 100000)
+        self._measure('install_fill_margin_amount', rows, _fill_margin_amount, self.env, 100000)
+        # One UPDATE per chunk plus a bounded setup, whatever the number of lines
+        for result in self.results[-2:]:
+            self.assertLessEqual(result['queries'], chunks + 20)
+
+        self.env.cr.execute(SQL(
+            "SELECT COUNT(*) FROM sale_order_line WHERE cost_price IS NULL OR margin_amount IS NULL"
+        ))
+        self.assertEqual(self.env.cr.fetchone()[0], 0)
+
+    def test_simulate_margin_prices(self):
+        """
+        Price 10k (product, quantity, margin) tuples in one simulation call
+        and check that the number of queries does not depend on their number.
+        """
+        pricing = self.env['sale.line.margin.pricing']
+        pricelist = self.env['product.pricelist'].create({
+            'name': 'Benchmark Pricelist',
+        })
+        rng = random.Random(42)
+        for size in (1000, 10000):
+            items = [{
+                'product_id': self.products[i % len(self.products)].id,
+                'quantity': rng.randint(1, 100),
+                'margin_percent': rng.uniform(0.0, 80.0),
+                'pricelist_id': pricelist.id,
+            } for i in range(size)]
+            self.env.invalidate_all()
+            results = self._measure('simulate', size, pricing.simulate_margin_prices, items)
+            self.assertEqual(len(results), size)
+
+        small, large = self.results[-2:]
+        self.assertEqual(small['queries'], large['queries'])
+
+    def _run_concurrent_margin_writes(self, line_ids, users, rounds):
+        """
+        Have users threads change the margin of random, overlapping halves
+        of line_ids, rounds times each, every change in its own transaction
+        run through the server retry loop.
+
+        :return: dict with the number of transactions, of retries by cause
+            and of changes that still failed after all retries
+        """
+        stats = {'transactions': 0, 'serialization_failures': 0, 'deadlocks': 0, 'failures': 0}
+        stats_lock = threading.Lock()
+
+        def count(key):
+            with stats_lock:
+                stats[key] += 1
+
+        def user(seed):
+            rng = random.Random(seed)
+            for _round in range(rounds):
+                ids = rng.sample(line_ids, len(line_ids) // 2)
+                margin = round(rng.uniform(5.0, 60.0), 2)
+                with self.registry.cursor() as cr:
+                    env = api.Environment(cr, SUPERUSER_ID, {})
+
+                    def write_margin():
+                        try:
+                            env['sale.order.line'].browse(ids).write({'margin_percent': margin})
+                            env.flush_all()
+                        except Exception as e:
+                            if getattr(e, 'pgcode', None) == errorcodes.DEADLOCK_DETECTED:
+                                count('deadlocks')
+                            elif getattr(e, 'pgcode', None) == errorcodes.SERIALIZATION_FAILURE:
+                                count('serialization_failures')
+                            raise
+
+                    try:
+                        retrying(write_margin, env)
+                        count('transactions')
+                    except Exception:
+                        count('failures')
+
+        threads = [threading.Thread(target=user, args=(seed,)) for seed in range(users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return stats
+
+    def test_concurrent_margin_updates(self):
+        """
+        Several users change the margin of lines of the same large quotation
+        at the same time, in committed transactions of their own. Compare
+        the retries (deadlocks, serialization failures) of the default write
+        and of the concurrent update mode.
+
+        The quotation is created and removed in separate committed
+        transactions, as the threads cannot see the test transaction.
+        """
+        size = int(os.environ.get(CONCURRENT_BENCHMARK_LINES_ENV) or DEFAULT_CONCURRENT_BENCHMARK_LINES)
+        users = int(os.environ.get(CONCURRENT_BENCHMARK_USERS_ENV) or DEFAULT_CONCURRENT_BENCHMARK_USERS)
+        with self.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            partner = env['res.partner'].create({'name': 'Concurrent Benchmark Customer'})
+            products = env['product.product'].create([{
+                'name': f'Concurrent Benchmark Product {i}',
+                'type': 'consu',
+                'standard_price': 10.0 + i,
+            } for i in range(10)])
+            order = env['sale.order'].create({'partner_id': partner.id})
+            env['sale.order.line'].create([{
+                'order_id': order.id,
+                'product_id': products[i % len(products)].id,
+                'product_uom_qty': 1.0,
+            } for i in range(size)])
+            line_ids = order.order_line.ids
+            record_ids = (partner.id, products.ids, order.id)
+
+        try:
+            for mode in ('default', 'concurrent'):
+                with self.registry.cursor() as cr:
+                    env = api.Environment(cr, SUPERUSER_ID, {})
+                    env['ir.config_parameter'].set_param(
+                        'sale_line_margin_price.concurrent_updates', mode == 'concurrent',
+                    )
+                stats, elapsed = self._timeit(self._run_concurrent_margin_writes, line_ids, users, 5)
+                retries = stats['serialization_failures'] + stats['deadlocks']
+                self.results.append(dict(stats, operation=f'concurrent_write_margin_{mode}_mode', size=size,
+                                         users=users, seconds=elapsed,
+                                         retry_rate=retries / max(stats['transactions'], 1)))
+                _logger.info("concurrent margin writes, %s mode, %s users: %s in %.3fs", mode, users, stats, elapsed)
+            self.assertEqual(self.results[-1]['deadlocks'], 0, "Locks are taken in a deterministic order")
+            self.assertEqual(self.results[-1]['failures'], 0)
+        finally:
+            partner_id, product_ids, order_id = record_ids
+            with self.registry.cursor() as cr:
+                env = api.Environment(cr, SUPERUSER_ID, {})
+                env['ir.config_parameter'].set_param('sale_line_margin_price.concurrent_updates', False)
+                env['sale.order'].browse(order_id).unlink()
+                env['product.product'].browse(product_ids).unlink()
+                env['res.partner'].browse(partner_id).unlink()
+
+    def test_quotation_templates(self):
+        """
+        Apply quotation templates of 500+ lines, from the template onchange
+        and in batch, and check that product costs are read once per
+        application whatever the number of lines.
+        """
+        Pricing = self.env.registry['sale.line.margin.pricing']
+        for size in (500, 2000):
+            template = self.env['sale.order.template'].create({
+                'name': f'Benchmark Template {size}',
+                'sale_order_template_line_ids': [(0, 0, {
+                    'product_id': self.products[i % len(self.products)].id,
+                    'product_uom_qty': 1.0 + i % 5,
+                    'margin_percent': 20.0 + i % 10,
+                }) for i in range(size)],
+            })
+            order = self.env['sale.order'].create({'partner_id': self.partner.id})
+            new_order = self.env['sale.order'].new({'partner_id': self.partner.id, 'sale_order_template_id': template.id})
+            with patch.object(Pricing, '_get_costs', autospec=True, side_effect=Pricing._get_costs) as get_costs:
+                self._measure('template_onchange', size, new_order._onchange_sale_order_template_id)
+                self._measure('template_apply', size, order._apply_margin_template, template)
+            self.assertEqual(get_costs.call_count, 2)
+            self.assertEqual(len(order.order_line), size)
@@ -0,0 +1,3 @@
+# -*- coding: utf-8 -*-
+
+from .metrics import METRICS_ENABLED_PARAM, METRICS_TOKEN_PARAM, instrumented, margin_metrics
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import functools
+import logging
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+# ir.config_parameter switching the instrumentation on ('1'/'True')
+METRICS_ENABLED_PARAM = 'sale_line_margin_price.metrics_enabled'
+# ir.config_parameter holding the bearer token of the metrics endpoint,
+# which is disabled while it is not set
+METRICS_TOKEN_PARAM = 'sale_line_margin_price.metrics_token'
+
+# Minimum number of seconds between two summaries in the server log
+METRICS_LOG_INTERVAL = 300
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class MarginMetrics:
+    """
+    In-process metrics of the margin pricing entry points: call counts,
+    records processed, SQL queries and latency histograms.
+
+    Metrics are kept per server process (each prefork worker has its own).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._last_log = time.monotonic()
+
+    def record(self, entry_point, records, queries, seconds):
+        """Account one call of entry_point"""
+        with self._lock:
+            stats = self._stats.get(entry_point)
+            if stats is None:
+                stats = self._stats[entry_point] = {
+                    'calls': 0,
+                    'records': 0,
+                    'queries': 0,
+                    'seconds': 0.0,
+                    'buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+                }
+            stats['calls'] += 1
+            stats['records'] += records
+            stats['queries'] += queries
+            stats['seconds'] += seconds
+            stats['buckets'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+            now = time.monotonic()
+            log_summary = now - self._last_log >= METRICS_LOG_INTERVAL
+            if log_summary:
+                self._last_log = now
+        if log_summary:
+            _logger.info("Margin pricing metrics:\n%s", self.summary())
+
+    def snapshot(self):
+        """Return a copy of the stats {entry_point: stats}"""
+        with self._lock:
+            return {
+                entry_point: dict(stats, buckets=list(stats['buckets']))
+                for entry_point, stats in self._stats.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def summary(self):
+        """Human-readable summary, one line per entry point"""
+        return '\n'.join(
+            "%s: %d calls, %d records, %d queries, %.3fs (avg %.1fms)" % (
+                entry_point, stats['calls'], stats['records'], stats['queries'],
+                stats['seconds'], 1000.0 * stats['seconds'] / stats['calls'],
+            )
+            for entry_point, stats in sorted(self.snapshot().items())
+        )
+
+    def render_prometheus(self):
+        """Render the metrics in the Prometheus text exposition format"""
+        snapshot = sorted(self.snapshot().items())
+        lines = []
+        for name, key, help_text in (
+            ('sale_margin_calls_total', 'calls', 'Calls of margin pricing entry points'),
+            ('sale_margin_records_total', 'records', 'Records processed by margin pricing entry points'),
+            ('sale_margin_queries_total', 'queries', 'SQL queries issued by margin pricing entry points'),
+        ):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for entry_point, stats in snapshot:
+                lines.append(f'{name}{{entry_point="{entry_point}"}} {stats[key]}')
+
+        name = 'sale_margin_latency_seconds'
+        lines.append(f'# HELP {name} Latency of margin pricing entry points')
+        lines.append(f'# TYPE {name} histogram')
+        for entry_point, stats in snapshot:
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), stats['buckets']):
+                cumulative += count
+                lines.append(f'{name}_bucket{{entry_point="{entry_point}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{entry_point="{entry_point}"}} {stats["seconds"]}')
+            lines.append(f'{name}_count{{entry_point="{entry_point}"}} {stats["calls"]}')
+        return '\n'.join(lines) + '\n'
+
+
+margin_metrics = MarginMetrics()
+
+
+def _count_self(records, *args, **kwargs):
+    return len(records)
+
+
+def instrumented(entry_point, count_records=_count_self):
+    """
+    Decorator recording the metrics of a model method under entry_point,
+    when the METRICS_ENABLED_PARAM system parameter is set. When it is not,
+    the only overhead is the lookup of the flag in the registry cache.
+
+    :param count_records: callable(self, *args, **kwargs) returning the
+        number of records processed by the call, defaults to len(self)
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not self.env['sale.line.margin.pricing']._is_metrics_enabled():
+                return method(self, *args, **kwargs)
+
+            cr = self.env.cr
+            queries_before = cr.sql_log_count
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                margin_metrics.record(
+                    entry_point,
+                    count_records(self, *args, **kwargs),
+                    cr.sql_log_count - queries_before,
+                    time.perf_counter() - start,
+                )
+        return wrapper
+    return decorator
@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+
+from . import sale_margin_line_import
+from . import sale_order_target_margin
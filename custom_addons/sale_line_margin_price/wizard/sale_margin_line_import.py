@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import io
+import logging
+import os
+
+from odoo import models, fields, api, _
+from odoo.exceptions import UserError
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_IMPORT_BATCH_SIZE = 1000
+
+# Column headers of the import file
+PRODUCT_COLUMN = 'default_code'
+QUANTITY_COLUMN = 'product_uom_qty'
+MARGIN_COLUMN = 'margin_percent'
+DESCRIPTION_COLUMN = 'name'
+
+
+class SaleMarginLineImport(models.TransientModel):
+    """
+    Import quotation lines with a margin_percent column from a CSV or XLSX
+    file.
+
+    The file is streamed: rows are read and priced in batches of batch_size,
+    each batch is created with a single create() call and then dropped from
+    the cache, so memory stays flat whatever the file size.
+    """
+    _name = 'sale.margin.line.import'
+    _description = 'Import Quotation Lines with Margin'
+
+    order_id = fields.Many2one(
+        'sale.order',
+        string='Quotation',
+        required=True,
+        domain=[('state', 'in', ('draft', 'sent'))],
+    )
+    import_file = fields.Binary(
+        string='File',
+        required=True,
+        attachment=True,
+        help='CSV or XLSX file with the columns: default_code, product_uom_qty, margin_percent '
+             'and optionally name'
+    )
+    filename = fields.Char(string='File Name')
+    batch_size = fields.Integer(
+        string='Batch Size',
+        default=DEFAULT_IMPORT_BATCH_SIZE,
+        help='Number of lines priced and created at once'
+    )
+
+    def action_import(self):
+        self.ensure_one()
+        file_type = os.path.splitext(self.filename or '')[1].lower().lstrip('.')
+        # Read the stored file from the filestore rather than loading it in memory
+        attachment = self.env['ir.attachment'].sudo().search([
+            ('res_model', '=', self._name),
+            ('res_id', '=', self.id),
+            ('res_field', '=', 'import_file'),
+        ], limit=1)
+        if attachment.store_fname:
+            fileobj = open(attachment._full_path(attachment.store_fname), 'rb')
+        else:
+            fileobj = io.BytesIO(attachment.raw)
+        with fileobj:
+            self.import_margin_lines(self.order_id, fileobj, file_type, batch_size=self.batch_size)
+        return {'type': 'ir.actions.act_window_close'}
+
+    @api.model
+    def import_margin_lines(self, order, fileobj, file_type, batch_size=DEFAULT_IMPORT_BATCH_SIZE,
+                            progress_callback=None):
+        """
+        Stream order lines from fileobj into the quotation order.
+
+        :param order: sale.order record, in draft or sent state
+        :param fileobj: binary file object of the CSV or XLSX file
+        :param str file_type: 'csv' or 'xlsx'
+        :param int batch_size: number of lines priced and created at once
+        :param progress_callback: optional callable receiving the number of
+            lines imported so far, after each batch
+        :return: number of imported lines
+        """
+        order.ensure_one()
+        if order.state not in ('draft', 'sent'):
+            raise UserError(_("Lines can only be imported into quotations."))
+        batch_size = max(batch_size or DEFAULT_IMPORT_BATCH_SIZE, 1)
+
+        rows = self._iter_file_rows(fileobj, file_type)
+        order_id = order.id
+        imported = 0
+        batch = []
+        for row_number, row in enumerate(rows, start=2):
+            batch.append((row_number, row))
+            if len(batch) >= batch_size:
+                imported += self._import_batch(order_id, batch)
+                batch = []
+                self._notify_import_progress(imported, progress_callback)
+        if batch:
+            imported += self._import_batch(order_id, batch)
+            self._notify_import_progress(imported, progress_callback)
+        return imported
+
+    @api.model
+    def _iter_file_rows(self, fileobj, file_type):
+        """Yield the rows of the file as dicts {header: value}, one at a time"""
+        if file_type == 'csv':
+            yield from csv.DictReader(io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline=''))
+        elif file_type == 'xlsx':
+            if openpyxl is None:
+                raise UserError(_("The openpyxl library is required to import XLSX files."))
+            workbook = openpyxl.load_workbook(fileobj, read_only=True, data_only=True)
+            try:
+                sheet_rows = workbook.worksheets[0].iter_rows(values_only=True)
+                headers = [str(header or '').strip() for header in next(sheet_rows, ())]
+                for values in sheet_rows:
+                    yield dict(zip(headers, values))
+            finally:
+                workbook.close()
+        else:
+            raise UserError(_("Unsupported file type %s, use a CSV or XLSX file.", file_type))
+
+    @api.model
+    def _import_batch(self, order_id, batch):
+        """
+        Create the lines of one batch of (row number, row) in a single
+        create() call, which prices them all through the margin logic.
+        """
+        codes = {str(row.get(PRODUCT_COLUMN) or '').strip() for _row_number, row in batch}
+        products = self.env['product.product'].search([('default_code', 'in', list(codes))])
+        product_ids = {product.default_code: product.id for product in products}
+
+        vals_list = []
+        for row_number, row in batch:
+            code = str(row.get(PRODUCT_COLUMN) or '').strip()
+            if code not in product_ids:
+                raise UserError(_("Line %(row)s: unknown product reference %(code)r.", row=row_number, code=code))
+            quantity = self._parse_number(row_number, row, QUANTITY_COLUMN)
+            vals = {
+                'order_id': order_id,
+                'product_id': product_ids[code],
+                'product_uom_qty': 1.0 if quantity is None else quantity,
+            }
+            # Without a margin, the line gets the default or margin rule margin
+            margin_percent = self._parse_number(row_number, row, MARGIN_COLUMN)
+            if margin_percent is not None:
+                vals['margin_percent'] = margin_percent
+            if row.get(DESCRIPTION_COLUMN):
+                vals['name'] = row[DESCRIPTION_COLUMN]
+            vals_list.append(vals)
+
+        self.env['sale.order.line'].create(vals_list)
+        # Write the batch and drop it from the cache to keep memory flat
+        self.env.flush_all()
+        self.env.invalidate_all()
+        return len(vals_list)
+
+    @api.model
+    def _parse_number(self, row_number, row, column):
+        """Number in the column of row, None when the cell is empty"""
+        value = row.get(column)
+        if value is None or (isinstance(value, str) and not value.strip()):
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            raise UserError(_(
+                "Line %(row)s: %(column)s must be a number, not %(value)r.",
+                row=row_number, column=column, value=value,
+            ))
+
+    @api.model
+    def _notify_import_progress(self, imported, progress_callback=None):
+        _logger.info("Margin line import: %s lines imported", imported)
+        if progress_callback:
+            progress_callback(imported)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api
+
+
+class SaleOrderTargetMargin(models.TransientModel):
+    """
+    Reach a target overall margin on a quotation by solving the margin of
+    its lines, optionally keeping some lines at their current price.
+    """
+    _name = 'sale.order.target.margin'
+    _description = 'Apply a Target Margin to a Quotation'
+
+    order_id = fields.Many2one(
+        'sale.order',
+        string='Quotation',
+        required=True,
+        domain=[('state', 'in', ('draft', 'sent'))],
+    )
+    current_margin = fields.Float(
+        string='Current Margin %',
+        compute='_compute_current_margin',
+    )
+    target_margin = fields.Float(
+        string='Target Margin %',
+        required=True,
+        help='Overall margin of the quotation on its cost, like the margin % of the lines'
+    )
+    method = fields.Selection(
+        [
+            ('uniform', 'Same margin on every line'),
+            ('shift', 'Shift every line margin by the same amount'),
+        ],
+        string='Method',
+        required=True,
+        default='uniform',
+    )
+    margin_rounding = fields.Float(
+        string='Margin Rounding',
+        default=0.01,
+        help='Step the line margins are rounded to, e.g. 0.5 for half percents'
+    )
+    locked_line_ids = fields.Many2many(
+        'sale.order.line',
+        string='Locked Lines',
+        domain="[('order_id', '=', order_id), ('display_type', '=', False)]",
+        help='Lines keeping their current price'
+    )
+
+    @api.depends('order_id')
+    def _compute_current_margin(self):
+        for wizard in self:
+            wizard.current_margin = wizard.order_id._get_overall_margin_percent() if wizard.order_id else 0.0
+
+    def action_apply(self):
+        self.ensure_one()
+        self.order_id.apply_target_margin(
+            self.target_margin,
+            locked_lines=self.locked_line_ids,
+            method=self.method,
+            margin_rounding=self.margin_rounding,
+        )
+        return {'type': 'ir.actions.act_window_close'}
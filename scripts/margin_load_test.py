@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Concurrent-user load test of quotation editing with sale_line_margin_price.
+
+Drives a running Odoo (see scripts/start.sh and config/odoo.conf) over
+JSON-RPC: every simulated salesperson creates quotations, changes the
+margin of their lines, swaps products and confirms orders in a loop.
+Latency percentiles, throughput and serialization failure rates are
+reported per operation.
+
+Example, 50 users for 2 minutes:
+
+    scripts/margin_load_test.py --db project1 --login admin --password admin \\
+        --users 50 --duration 120 --json load_test.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import urllib.request
+
+OPERATIONS = ('create_quotation', 'write_margin', 'swap_product', 'confirm')
+
+# Markers of a PostgreSQL serialization failure in an Odoo RPC error, once
+# the server has exhausted its own retries
+SERIALIZATION_FAILURE_MARKERS = (
+    'could not serialize access',
+    'SerializationFailure',
+    'TransactionRollbackError',
+    'deadlock detected',
+)
+
+
+class RpcError(Exception):
+    """Error returned by the Odoo server for a JSON-RPC call"""
+
+    def __init__(self, error):
+        data = error.get('data') or {}
+        super().__init__(data.get('message') or error.get('message') or str(error))
+        self.error = error
+
+    @property
+    def is_serialization_failure(self):
+        text = json.dumps(self.error)
+        return any(marker in text for marker in SERIALIZATION_FAILURE_MARKERS)
+
+
+class OdooClient:
+    """Minimal JSON-RPC client, one per simulated user"""
+
+    _ids = itertools.count()
+
+    def __init__(self, url, db, login, password, timeout):
+        self.url = url.rstrip('/') + '/jsonrpc'
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self.uid = self._call('common', 'login', db, login, password)
+        if not self.uid:
+            raise SystemExit(f"Login failed for {login!r} on database {db!r}")
+
+    def _call(self, service, method, *args):
+        payload = json.dumps({
+            'jsonrpc': '2.0',
+            'method': 'call',
+            'params': {'service': service, 'method': method, 'args': args},
+            'id': next(self._ids),
+        }).encode()
+        request = urllib.request.Request(self.url, payload, {'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            result = json.load(response)
+        if result.get('error'):
+            raise RpcError(result['error'])
+        return result['result']
+
+    def execute(self, model, method, *args, **kwargs):
+        return self._call('object', 'execute_kw', self.db, self.uid, self.password, model, method, args, kwargs)
+
+
+class Stats:
+    """Thread-safe latency and error counters per operation"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {operation: [] for operation in OPERATIONS}
+        self.errors = dict.fromkeys(OPERATIONS, 0)
+        self.serialization_failures = dict.fromkeys(OPERATIONS, 0)
+
+    def record(self, operation, seconds, error=None):
+        with self.lock:
+            if error is None:
+                self.latencies[operation].append(seconds)
+            elif isinstance(error, RpcError) and error.is_serialization_failure:
+                self.serialization_failures[operation] += 1
+            else:
+                self.errors[operation] += 1
+
+    def report(self, elapsed):
+        report = {}
+        for operation in OPERATIONS:
+            latencies = sorted(self.latencies[operation])
+            failures = self.serialization_failures[operation]
+            errors = self.errors[operation]
+            attempts = len(latencies) + failures + errors
+            report[operation] = {
+                'ok': len(latencies),
+                'errors': errors,
+                'serialization_failures': failures,
+                'serialization_failure_rate': failures / attempts if attempts else 0.0,
+                'throughput': len(latencies) / elapsed if elapsed else 0.0,
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+            }
+        return report
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already sorted list, None if empty"""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, round(percent / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def timed(stats, operation, func, *args, **kwargs):
+    """Run func, record its latency or failure under operation"""
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    except (RpcError, OSError) as e:
+        stats.record(operation, time.perf_counter() - start, error=e)
+        return None
+    stats.record(operation, time.perf_counter() - start)
+    return result
+
+
+def simulate_user(args, stats, partner_ids, product_ids, deadline, seed):
+    """One salesperson editing quotations until deadline or args.iterations"""
+    rng = random.Random(seed)
+    client = OdooClient(args.url, args.db, args.login, args.password, args.timeout)
+    iteration = 0
+    while time.monotonic() < deadline and (not args.iterations or iteration < args.iterations):
+        iteration += 1
+        order_id = timed(stats, 'create_quotation', client.execute, 'sale.order', 'create', {
+            'partner_id': rng.choice(partner_ids),
+            'order_line': [(0, 0, {
+                'product_id': rng.choice(product_ids),
+                'product_uom_qty': rng.randint(1, 10),
+            }) for _i in range(args.lines)],
+        })
+        if not order_id:
+            continue
+        line_ids = client.execute('sale.order.line', 'search', [('order_id', '=', order_id)])
+
+        for _i in range(args.edits):
+            timed(stats, 'write_margin', client.execute, 'sale.order.line', 'write',
+                  rng.sample(line_ids, max(1, len(line_ids) // 2)), {'margin_percent': rng.uniform(5.0, 60.0)})
+            timed(stats, 'swap_product', client.execute, 'sale.order.line', 'write',
+                  [rng.choice(line_ids)], {'product_id': rng.choice(product_ids)})
+
+        if rng.random() < args.confirm_ratio:
+            timed(stats, 'confirm', client.execute, 'sale.order', 'action_confirm', [order_id])
+        if args.think_time:
+            time.sleep(rng.uniform(0, 2 * args.think_time))
+
+
+def print_report(report, elapsed, users):
+    print(f"\n{users} users, {elapsed:.1f}s")
+    header = f"{'operation':<18}{'ok':>8}{'errors':>8}{'ser.fail':>10}{'rate':>8}{'ops/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+    print(header)
+    print('-' * len(header))
+
+    def ms(value):
+        return f"{value * 1000:.0f}" if value is not None else '-'
+
+    for operation, row in report.items():
+        print(
+            f"{operation:<18}{row['ok']:>8}{row['errors']:>8}{row['serialization_failures']:>10}"
+            f"{row['serialization_failure_rate']:>8.1%}{row['throughput']:>9.2f}"
+            f"{ms(row['p50']):>9}{ms(row['p95']):>9}{ms(row['p99']):>9}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8169', help="Odoo URL (http_port of config/odoo.conf)")
+    parser.add_argument('--db', required=True, help="database name")
+    parser.add_argument('--login', default='admin')
+    parser.add_argument('--password', default=os.environ.get('ODOO_PASSWORD', 'admin'),
+                        help="password or API key, defaults to $ODOO_PASSWORD")
+    parser.add_argument('--users', type=int, default=50, help="number of concurrent users")
+    parser.add_argument('--duration', type=float, default=60.0, help="seconds to run")
+    parser.add_argument('--iterations', type=int, default=0, help="quotations per user (0: until --duration)")
+    parser.add_argument('--lines', type=int, default=10, help="lines per quotation")
+    parser.add_argument('--edits', type=int, default=3, help="margin/product edits per quotation")
+    parser.add_argument('--confirm-ratio', type=float, default=0.5, help="share of quotations confirmed")
+    parser.add_argument('--think-time', type=float, default=0.0, help="mean pause between quotations (s)")
+    parser.add_argument('--timeout', type=float, default=120.0, help="RPC timeout (s)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--concurrent-updates', choices=('on', 'off'),
+                        help="switch the concurrent margin update mode before the run (default: leave as is)")
+    parser.add_argument('--json', help="also write the report to this file")
+    args = parser.parse_args()
+
+    client = OdooClient(args.url, args.db, args.login, args.password, args.timeout)
+    if args.concurrent_updates:
+        client.execute('ir.config_parameter', 'set_param',
+                       'sale_line_margin_price.concurrent_updates', args.concurrent_updates == 'on')
+    partner_ids = client.execute('res.partner', 'search', [('customer_rank', '>', 0)], limit=100) \
+        or client.execute('res.partner', 'search', [], limit=100)
+    product_ids = client.execute('product.product', 'search', [('sale_ok', '=', True)], limit=100)
+    if not partner_ids or not product_ids:
+        raise SystemExit("The database needs customers and saleable products")
+
+    stats = Stats()
+    deadline = time.monotonic() + args.duration
+    threads = [
+        threading.Thread(
+            target=simulate_user,
+            args=(args, stats, partner_ids, product_ids, deadline, args.seed + user),
+            name=f'user-{user}',
+        )
+        for user in range(args.users)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    report = stats.report(elapsed)
+    print_report(report, elapsed, args.users)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'users': args.users,
+                'concurrent_updates': args.concurrent_updates,
+                'seconds': elapsed,
+                'operations': report,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()